@@ -0,0 +1,123 @@
+"""
+Versioned, memory-mappable artifact format for the prediction services.
+
+Unpickling the scikit-learn objects at startup costs every worker the scikit-learn
+import and its own private copy of every array. Serving only needs the numbers, so
+training also exports them as NumPy arrays in uncompressed .npz bundles, described by
+a JSON manifest: the format version, the feature schema the model was trained on, and
+the dtype and shape of every array. Bundles are opened by memory-mapping each member
+in place inside the .npz (np.load ignores mmap_mode for .npz files), so workers share
+the same page cache and loading costs no copies.
+
+read_manifest() and open_bundle() raise ArtifactError when the format version, the
+feature schema or an array doesn't match what the loading code expects.
+"""
+import json
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+FORMAT_VERSION = 1
+_LOCAL_HEADER_SIZE = 30 # fixed part of a zip local file header
+
+
+class ArtifactError(ValueError):
+    """An artifact that is missing pieces or doesn't match the code loading it."""
+
+
+def write_bundle(path, arrays):
+    """Saves arrays as an uncompressed .npz and returns their manifest entry."""
+    arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items()}
+    for name, value in arrays.items():
+        if value.dtype.hasobject:
+            raise ArtifactError(f"Array '{name}' holds Python objects and can't be memory-mapped; store strings as a 'U' array.")
+    # Replaced atomically: running workers keep their mappings of the old file.
+    with open(f"{path}.tmp", 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(f"{path}.tmp", path)
+    return {
+        "file": os.path.basename(path),
+        "arrays": {name: {"dtype": value.dtype.str, "shape": list(value.shape)} for name, value in arrays.items()},
+    }
+
+
+def write_manifest(path, kind, bundles, **metadata):
+    """Atomically writes a manifest for bundles written with write_bundle()."""
+    manifest = {"formatVersion": FORMAT_VERSION, "kind": kind, "bundles": bundles, **metadata}
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+    return manifest
+
+
+def read_manifest(path, kind, **expected):
+    """
+    Reads a manifest, or returns None if there is none. Every keyword must match the manifest
+    exactly, e.g. featureColumns=FEATURE_COLUMNS, so schema drift fails at load time instead of
+    producing wrong predictions.
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise ArtifactError(f"Unreadable artifact manifest '{path}': {e}")
+    if manifest.get('formatVersion') != FORMAT_VERSION:
+        raise ArtifactError(f"'{path}' is artifact format {manifest.get('formatVersion')}; this code reads format {FORMAT_VERSION}.")
+    if manifest.get('kind') != kind:
+        raise ArtifactError(f"'{path}' describes '{manifest.get('kind')}' artifacts, not '{kind}'.")
+    for key, value in expected.items():
+        if manifest.get(key) != value:
+            raise ArtifactError(f"'{path}' was built with {key}={manifest.get(key)!r}, but this code expects {value!r}. Retrain or re-export the artifacts.")
+    return manifest
+
+
+def open_bundle(directory, manifest, name, required=()):
+    """Memory-maps one bundle of a manifest, checking every array against the manifest's dtype and shape."""
+    spec = manifest['bundles'].get(name)
+    if spec is None:
+        raise ArtifactError(f"The manifest has no '{name}' bundle.")
+    arrays = _memmap_npz(os.path.join(directory, spec['file']))
+    for array_name, expected in spec['arrays'].items():
+        array = arrays.get(array_name)
+        if array is None:
+            raise ArtifactError(f"'{spec['file']}' is missing array '{array_name}'.")
+        if array.dtype.str != expected['dtype'] or list(array.shape) != expected['shape']:
+            raise ArtifactError(f"'{spec['file']}:{array_name}' is {array.dtype.str}{list(array.shape)}, "
+                                f"the manifest says {expected['dtype']}{expected['shape']}.")
+    missing = [array_name for array_name in required if array_name not in arrays]
+    if missing:
+        raise ArtifactError(f"'{spec['file']}' is missing arrays {missing}.")
+    return arrays
+
+
+def _memmap_npz(path):
+    """Maps every member of an uncompressed .npz read-only, without reading the array data."""
+    arrays = {}
+    with zipfile.ZipFile(path) as archive:
+        members = archive.infolist()
+    with open(path, 'rb') as f:
+        for member in members:
+            if not member.filename.endswith('.npy'):
+                continue
+            if member.compress_type != zipfile.ZIP_STORED:
+                raise ArtifactError(f"'{path}' is compressed and can't be memory-mapped.")
+            f.seek(member.header_offset)
+            header = f.read(_LOCAL_HEADER_SIZE)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(member.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = member.filename[:-len('.npy')]
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C').view(np.ndarray)
+    return arrays
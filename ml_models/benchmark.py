@@ -0,0 +1,409 @@
+"""
+Benchmarks for the owner and location prediction services.
+
+Request payloads are synthesized from the ids and value formats found in datasets/*.csv
+(locations, access points, entities, cards, face ids) at a configurable scale and a fixed
+seed, then sent to each Flask app in-process through its test client, so the numbers cover
+body parsing, feature building, inference and response serialization but not the network.
+Prediction caches are disabled while measuring unless --cached is given.
+
+Training is timed in a fresh subprocess per service and dataset size, working in a
+temporary directory whose datasets are the real CSVs repeated 1x, 10x, 100x... with each
+copy shifted later in time, so the training code reads them exactly as it reads the originals.
+
+Results are written as JSON. With --baseline, each metric is compared against an earlier
+results file and the run exits with status 1 if any of them regressed beyond --threshold.
+
+    python ml_models/benchmark.py --candidates 500 --evidence 20000 --output bench.json
+    python ml_models/benchmark.py --baseline bench.json --train-scales 1,10
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+ML_MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = "datasets"
+RESULTS_VERSION = 1
+TIME_COLUMNS = {
+    'campus_card_swipes.csv': ['timestamp'], 'wifi_associations_logs.csv': ['timestamp'], 'cctv_frames.csv': ['timestamp'],
+    'lab_bookings.csv': ['start_time', 'end_time'], 'library_checkouts.csv': ['timestamp'],
+    'free_text_notes (helpdesk or RSVPs).csv': ['timestamp'],
+}
+LATENCY_METRICS = ('p50_ms', 'p95_ms', 'p99_ms')
+LOWER_IS_BETTER = LATENCY_METRICS + ('peak_rss_mb', 'peak_tree_pss_mb', 'seconds')
+TREE_SAMPLE_SECONDS = 0.1
+
+# --- Measurement ---
+
+def _reset_peak_rss():
+    """Resets the kernel's peak-RSS mark for this process (Linux); returns False where unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    """Peak RSS since the last _reset_peak_rss(), or over the process lifetime where it can't be reset."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _rusage_mb(resource.getrusage(resource.RUSAGE_SELF))
+
+def _tree_pss_mb(root_pid):
+    """
+    Total proportional set size of a process and all its descendants (Linux), or None where
+    /proc can't tell. PSS splits copy-on-write pages shared with forked workers between them,
+    so the sum isn't inflated the way summed RSS would be.
+    """
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree, frontier = {root_pid}, [root_pid]
+    while frontier:
+        pid = frontier.pop()
+        children = [child for child, parent in parents.items() if parent == pid and child not in tree]
+        tree.update(children)
+        frontier.extend(children)
+    total_kb, measured = 0, False
+    for pid in tree:
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total_kb += int(line.split()[1])
+                        measured = True
+                        break
+        except OSError:
+            continue # exited meanwhile, or not readable
+    return total_kb / 1024 if measured else None
+
+def _rusage_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 1024)
+
+def measure(call, iterations, warmup):
+    """Runs call() warmup + iterations times and summarizes the timed iterations."""
+    for _ in range(warmup):
+        call()
+    _reset_peak_rss()
+    latencies = np.empty(iterations)
+    started = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        call()
+        latencies[i] = time.perf_counter() - t0
+    elapsed = time.perf_counter() - started
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "iterations": iterations, "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+        "mean_ms": latencies.mean() * 1000, "throughput_per_s": iterations / elapsed, "peak_rss_mb": _peak_rss_mb(),
+    }
+
+def _post_json(client, path, payload):
+    def call():
+        response = client.post(path, json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return call
+
+# --- Synthetic payloads ---
+
+def _time_format(sample):
+    return ('%m/%d/%Y %H:%M', '%-m/%-d/%Y %-H:%M') if '/' in sample else ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S')
+
+def load_vocabulary(data_dir=DATA_DIR):
+    """The ids a realistic payload draws from, taken from the dataset CSVs."""
+    profiles = pd.read_csv(os.path.join(data_dir, 'student_or_staff_profiles.csv'), dtype=str)
+    swipes = pd.read_csv(os.path.join(data_dir, 'campus_card_swipes.csv'), dtype=str)
+    cctv = pd.read_csv(os.path.join(data_dir, 'cctv_frames.csv'), dtype=str)
+    wifi = pd.read_csv(os.path.join(data_dir, 'wifi_associations_logs.csv'), dtype=str)
+    bookings = pd.read_csv(os.path.join(data_dir, 'lab_bookings.csv'), dtype=str)
+    return {
+        "users": profiles.dropna(subset=['entity_id'])[['entity_id', 'name', 'student_id', 'face_id']].to_dict('records'),
+        "locations": sorted(set(swipes['location_id'].dropna()) | set(cctv['location_id'].dropna()) | set(bookings['room_id'].dropna())),
+        "access_points": sorted(wifi['ap_id'].dropna().unique()),
+        "start": pd.to_datetime(swipes['timestamp']).min().to_pydatetime(),
+    }
+
+def owner_payload(vocabulary, n_candidates, n_anchors, n_evidence, rng):
+    """A /predict/owner body: anchor swipes, candidates, and n_evidence rows spread over the evidence tables."""
+    users = rng.sample(vocabulary['users'], min(n_candidates, len(vocabulary['users'])))
+    locations = vocabulary['locations']
+    start = vocabulary['start']
+
+    def timestamp(hours=72):
+        return (start + timedelta(seconds=rng.randrange(hours * 3600))).isoformat()
+
+    anchors = [{"locationId": rng.choice(locations), "timestamp": timestamp()} for _ in range(n_anchors)]
+    anchor_locations = [anchor['locationId'] for anchor in anchors]
+
+    def location():
+        # Most evidence is elsewhere on campus; some of it is where the card was swiped.
+        return rng.choice(anchor_locations) if rng.random() < 0.2 else rng.choice(locations)
+
+    n_wifi, n_cctv = n_evidence * 5 // 10, n_evidence * 3 // 10
+    n_bookings = n_evidence // 10
+    n_alibis = n_evidence - n_wifi - n_cctv - n_bookings
+    user_ids = [user['entity_id'] for user in users]
+    faces = [user['face_id'] for user in users if isinstance(user.get('face_id'), str)] or ['F0']
+    evidence = {
+        "wifiLogs": [{"device": {"userId": rng.choice(user_ids)}, "accessPointId": location(), "timestamp": timestamp()} for _ in range(n_wifi)],
+        "bookings": [{"userId": rng.choice(user_ids), "locationId": location()} for _ in range(n_bookings)],
+        "alibiSwipes": [{"card": {"userId": rng.choice(user_ids)}} for _ in range(n_alibis)],
+        "cctvFrames": [{"locationId": location(), "timestamp": timestamp(), "detectedFaceIds": rng.sample(faces, min(len(faces), rng.randrange(4)))} for _ in range(n_cctv)],
+        "user_to_face_map": {user['entity_id']: user['face_id'] for user in users if isinstance(user.get('face_id'), str)},
+    }
+    candidates = [{"id": user['entity_id'], "fullName": user['name'], "externalId": user['student_id']} for user in users]
+    return {"anchorEvents": anchors, "candidateUsers": candidates, "allEvidence": evidence}
+
+def location_payloads(vocabulary, location_names, n_history, n_gaps, rng):
+    """A /predict/location body and a /predict/location/timeline body with n_gaps unknown steps."""
+    all_locations = [{"id": i + 1, "name": name} for i, name in enumerate(location_names)]
+    start = vocabulary['start']
+    history = [{"locationId": rng.randrange(1, len(all_locations) + 1), "timestamp": (start + timedelta(minutes=rng.randrange(60 * 24 * 30))).isoformat()}
+               for _ in range(n_history)]
+    gap = {
+        "startTime": (start + timedelta(hours=10)).isoformat(), "endTime": (start + timedelta(hours=12)).isoformat(),
+        "allLocations": all_locations, "historicalActivity": history,
+        "locationBefore": rng.choice(all_locations), "locationAfter": rng.choice(all_locations),
+    }
+    timeline = []
+    for i in range(n_gaps):
+        at = start + timedelta(hours=2 * i)
+        timeline.append({"startTime": at.isoformat(), "location": rng.choice(all_locations)})
+        timeline.append({"id": i, "startTime": (at + timedelta(hours=1)).isoformat()})
+    timeline.append({"startTime": (start + timedelta(hours=2 * n_gaps)).isoformat(), "location": rng.choice(all_locations)})
+    return gap, {"allLocations": all_locations, "historicalActivity": history, "timeline": timeline}
+
+# --- Stages ---
+
+def benchmark_owner(args, vocabulary, rng):
+    import predict_owner
+    if predict_owner.artifacts is None:
+        return {}, "owner model artifacts not found; run 'python ml_models/predict_owner.py train'"
+    if not args.cached:
+        predict_owner.result_cache.max_bytes = 0
+    payload = owner_payload(vocabulary, args.candidates, args.anchors, args.evidence, rng)
+
+    def reference_features():
+        index = predict_owner.build_evidence_index(payload['allEvidence'])
+        for user in payload['candidateUsers']:
+            predict_owner.create_features_from_raw_data(payload['anchorEvents'], user, payload['allEvidence'], index)
+
+    def columnar_features():
+        columns = predict_owner.columnize_payload(payload['anchorEvents'], payload['allEvidence'])
+        predict_owner.build_pruned_features(columns, [columns], [user['id'] for user in payload['candidateUsers']])
+
+    client = predict_owner.app.test_client()
+    return {
+        "owner.create_features_from_raw_data": measure(reference_features, args.iterations, args.warmup),
+        "owner.build_pruned_features": measure(columnar_features, args.iterations, args.warmup),
+        "owner.predict": measure(_post_json(client, '/predict/owner', payload), args.iterations, args.warmup),
+    }, None
+
+def benchmark_location(args, vocabulary, rng):
+    import predict_location
+    artifacts = predict_location.current_artifacts()
+    if not artifacts:
+        return {}, "location model artifacts not found; run 'python ml_models/predict_location.py train'"
+    if not args.cached:
+        predict_location.result_cache.max_bytes = 0
+    known = list(artifacts['transitions']['locations'])
+    names = (known + [name for name in vocabulary['locations'] if name not in set(known)])[:args.locations]
+    names += [f"SYNTH_{i}" for i in range(args.locations - len(names))]
+    gap, timeline = location_payloads(vocabulary, names, args.history, args.gaps, rng)
+
+    client = predict_location.app.test_client()
+    return {
+        "location.predict": measure(_post_json(client, '/predict/location', gap), args.iterations, args.warmup),
+        "location.predict_timeline": measure(_post_json(client, '/predict/location/timeline', timeline), args.iterations, args.warmup),
+    }, None
+
+# --- Training ---
+
+def write_scaled_datasets(source_dir, target_dir, scale):
+    """Copies the dataset CSVs, repeating every event table `scale` times, each copy shifted past the previous one."""
+    os.makedirs(target_dir, exist_ok=True)
+    for name in os.listdir(source_dir):
+        source = os.path.join(source_dir, name)
+        if name not in TIME_COLUMNS or scale == 1:
+            shutil.copy2(source, os.path.join(target_dir, name))
+            continue
+        df = pd.read_csv(source, dtype=str)
+        parsed, formats = {}, {}
+        for col in TIME_COLUMNS[name]:
+            sample = df[col].dropna().iloc[0] if df[col].notna().any() else ''
+            formats[col] = _time_format(sample)
+            parsed[col] = pd.to_datetime(df[col], format=formats[col][0], errors='coerce')
+        span = max(parsed[col].max() - parsed[col].min() for col in parsed) + pd.Timedelta(days=1)
+        copies = []
+        for k in range(scale):
+            copy = df.copy()
+            for col in parsed:
+                shifted = (parsed[col] + span * k).dt.strftime(formats[col][1])
+                copy[col] = shifted.where(parsed[col].notna(), df[col])
+            copies.append(copy)
+        pd.concat(copies, ignore_index=True).to_csv(os.path.join(target_dir, name), index=False)
+
+# Runs a training script in the child and records that process's own peak RSS. ru_maxrss from
+# wait4() can't be used on Linux: a child starts with its parent's high-water mark, which survives exec.
+# The training process's own peak leaves out any worker processes it starts (the owner trainer's
+# ProcessPool), so a thread also samples the PSS of the whole process tree.
+_TRAINING_CHILD = """
+import json, os, runpy, sys, threading
+from benchmark import TREE_SAMPLE_SECONDS, _peak_rss_mb, _tree_pss_mb
+script, output = sys.argv[1], sys.argv[2]
+sys.argv = [script, 'train']
+tree_peak, done = [None], threading.Event()
+def sample_tree():
+    while not done.wait(TREE_SAMPLE_SECONDS):
+        pss = _tree_pss_mb(os.getpid())
+        if pss is not None:
+            tree_peak[0] = max(tree_peak[0] or 0.0, pss)
+threading.Thread(target=sample_tree, daemon=True).start()
+try:
+    runpy.run_path(script, run_name='__main__')
+finally:
+    done.set()
+    with open(output, 'w') as f:
+        json.dump({"peak_rss_mb": _peak_rss_mb(), "peak_tree_pss_mb": tree_peak[0]}, f)
+"""
+
+def time_training(service, workdir):
+    """
+    Runs '<service>.py train' in workdir. Returns wall seconds, the training process's own peak
+    RSS, and the peak total PSS of it and its worker processes, sampled every
+    TREE_SAMPLE_SECONDS (so shorter spikes can be missed; None where /proc isn't available).
+    """
+    peak_path = os.path.join(workdir, f"{service}.peak_rss")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [ML_MODELS_DIR, os.environ.get('PYTHONPATH')]))}
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', _TRAINING_CHILD, os.path.join(ML_MODELS_DIR, f"{service}.py"), peak_path],
+                               cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    seconds = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(f"{service} training failed:\n{completed.stderr.decode(errors='replace')[-2000:]}")
+    with open(peak_path) as f:
+        peaks = json.load(f)
+    return {"seconds": seconds, **{name: value for name, value in peaks.items() if value is not None}}
+
+def benchmark_training(scales, services):
+    results = {}
+    for scale in scales:
+        with tempfile.TemporaryDirectory(prefix=f"bench-{scale}x-") as workdir:
+            write_scaled_datasets(DATA_DIR, os.path.join(workdir, DATA_DIR), scale)
+            for service in services:
+                print(f"Training {service} on {scale}x datasets...")
+                results[f"{service}.{scale}x"] = time_training(service, workdir)
+    return results
+
+# --- Baseline comparison ---
+
+def _flatten(results):
+    for section in ('stages', 'training'):
+        for name, metrics in results.get(section, {}).items():
+            for metric, value in metrics.items():
+                if metric in LOWER_IS_BETTER or metric == 'throughput_per_s':
+                    yield f"{section}.{name}.{metric}", metric, value
+
+def compare(results, baseline, threshold):
+    """Returns (key, baseline, current, relative change) for every metric that got worse by more than threshold."""
+    previous = {key: value for key, _, value in _flatten(baseline)}
+    regressions = []
+    for key, metric, value in _flatten(results):
+        before = previous.get(key)
+        if not before:
+            continue
+        change = (value - before) / before
+        worse = change > threshold if metric in LOWER_IS_BETTER else change < -threshold
+        if worse:
+            regressions.append((key, before, value, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the owner and location prediction services. Run from the repository root.")
+    parser.add_argument('--candidates', type=int, default=200, help="Candidate users per owner request.")
+    parser.add_argument('--anchors', type=int, default=3, help="Anchor events per owner request.")
+    parser.add_argument('--evidence', type=int, default=5000, help="Evidence rows per owner request, across wifi, CCTV, bookings and alibis.")
+    parser.add_argument('--locations', type=int, default=50, help="Entries in 'allLocations' for location requests.")
+    parser.add_argument('--history', type=int, default=2000, help="Rows of 'historicalActivity' for location requests.")
+    parser.add_argument('--gaps', type=int, default=20, help="Gaps in the timeline sent to /predict/location/timeline.")
+    parser.add_argument('--iterations', type=int, default=50, help="Timed calls per stage.")
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed calls per stage before measuring.")
+    parser.add_argument('--seed', type=int, default=42, help="Seed for the synthetic payloads.")
+    parser.add_argument('--cached', action='store_true', help="Leave the prediction caches on (repeated requests then measure cache hits).")
+    parser.add_argument('--services', default='owner,location', help="Comma-separated services to benchmark.")
+    parser.add_argument('--train-scales', default='1,10,100', help="Comma-separated dataset multiples to time training at; empty to skip training.")
+    parser.add_argument('--output', default='benchmark_results.json', help="Where to write the results.")
+    parser.add_argument('--baseline', help="Earlier results file to compare against.")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Relative change beyond which a metric counts as a regression (default: 0.2).")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ML_MODELS_DIR)
+    services = [name.strip() for name in args.services.split(',') if name.strip()]
+    vocabulary = load_vocabulary()
+    results = {
+        "version": RESULTS_VERSION,
+        "meta": {
+            "createdAt": datetime.now().isoformat(timespec='seconds'), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(),
+            "scale": {key: getattr(args, key) for key in ('candidates', 'anchors', 'evidence', 'locations', 'history', 'gaps', 'iterations', 'seed', 'cached')},
+        },
+        "stages": {}, "training": {}, "skipped": [],
+    }
+    for service, run in (('owner', benchmark_owner), ('location', benchmark_location)):
+        if service not in services:
+            continue
+        stages, skipped = run(args, vocabulary, random.Random(args.seed))
+        results['stages'].update(stages)
+        if skipped:
+            results['skipped'].append(skipped)
+            print(f"Skipped {service}: {skipped}")
+
+    scales = [int(scale) for scale in args.train_scales.split(',') if scale.strip()]
+    results['training'] = benchmark_training(scales, [f"predict_{service}" for service in services])
+
+    for name, metrics in results['stages'].items():
+        print(f"{name:40s} p50 {metrics['p50_ms']:9.2f} ms  p95 {metrics['p95_ms']:9.2f} ms  p99 {metrics['p99_ms']:9.2f} ms  "
+              f"{metrics['throughput_per_s']:8.1f}/s  peak RSS {metrics['peak_rss_mb']:7.1f} MB")
+    for name, metrics in results['training'].items():
+        tree = f"  with workers {metrics['peak_tree_pss_mb']:7.1f} MB PSS" if 'peak_tree_pss_mb' in metrics else ""
+        print(f"train {name:34s} {metrics['seconds']:9.2f} s  peak RSS {metrics['peak_rss_mb']:7.1f} MB{tree}")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to '{args.output}'.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for key, before, after, change in regressions:
+            print(f"REGRESSION {key}: {before:.3f} -> {after:.3f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against '{args.baseline}'.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+"""
+Append-only, memory-mapped evidence store for the owner prediction service.
+
+Each table (swipes, wifi, cctv, bookings, library, profiles) is a list of
+immutable segments. A segment is a directory of .npy columns, sorted by
+(location, timestamp) where the table has a location, and opened with
+mmap_mode='r' so every worker shares the same page cache. Swipe segments also
+keep a card-sorted copy of the card column for per-card lookups. String ids from
+the datasets/*.csv schema are coded through one shared vocabulary (code 0 is
+"missing"; integer ids are stored as their decimal strings); timestamps are int64
+epoch microseconds of the wall-clock time.
+
+New rows arrive through ingest(), which writes a new sorted segment and swaps
+the manifest atomically; readers notice the new manifest on their next query.
+Writers are serialised with a lock file, so any worker process may ingest.
+"""
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Windows: only the in-process lock applies
+    fcntl = None
+
+MANIFEST_NAME = "manifest.json"
+VOCAB_NAME = "vocab.json"
+MAX_SEGMENTS_PER_TABLE = 16 # ingest() compacts a table once it has more segments than this
+
+# Store column -> CSV column, per table, following the datasets/*.csv schema.
+TABLE_SCHEMAS = {
+    'profiles': {
+        'csv': 'student_or_staff_profiles.csv',
+        'ids': {'entity': 'entity_id', 'name': 'name', 'student': 'student_id', 'staff': 'staff_id',
+                'card': 'card_id', 'device': 'device_hash', 'face': 'face_id'},
+        'times': {}, 'sort': ('entity',),
+    },
+    'swipes': {
+        'csv': 'campus_card_swipes.csv',
+        'ids': {'card': 'card_id', 'location': 'location_id'},
+        'times': {'time': 'timestamp'}, 'sort': ('location', 'time'),
+    },
+    'wifi': {
+        'csv': 'wifi_associations_logs.csv',
+        'ids': {'device': 'device_hash', 'location': 'ap_id'},
+        'times': {'time': 'timestamp'}, 'sort': ('location', 'time'),
+    },
+    'cctv': {
+        'csv': 'cctv_frames.csv',
+        'ids': {'location': 'location_id', 'face': 'face_id'},
+        'times': {'time': 'timestamp'}, 'sort': ('location', 'time'),
+    },
+    'bookings': {
+        'csv': 'lab_bookings.csv',
+        'ids': {'entity': 'entity_id', 'location': 'room_id'},
+        'times': {'start': 'start_time', 'end': 'end_time'}, 'sort': ('location', 'start'),
+    },
+    'library': {
+        'csv': 'library_checkouts.csv',
+        'ids': {'entity': 'entity_id'},
+        'times': {'time': 'timestamp'}, 'sort': ('time',),
+    },
+}
+
+
+def _parse_times(values):
+    """Parses timestamps in any of the datasets' formats to epoch microseconds (NaT -> int64 min)."""
+    import pandas as pd
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), format='mixed', utc=True, errors='coerce')
+    return parsed.dt.tz_localize(None).to_numpy(dtype='datetime64[us]').view(np.int64)
+
+
+@contextmanager
+def _file_lock(path):
+    """Serialises writers across worker processes (no-op where fcntl is unavailable)."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _merge_windows(windows):
+    """Sorts [start, end] windows and merges overlapping ones so no row is returned twice."""
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+class EvidenceStore:
+    """Time- and location-indexed evidence, queried by the owner service instead of request payloads."""
+
+    def __init__(self, root):
+        self.root = root
+        self._write_lock = threading.Lock()
+        self._manifest_version = None
+        self._snapshot = None
+        self.refresh()
+
+    @classmethod
+    def open(cls, root):
+        """Opens an existing store, or returns None if none has been built at `root`."""
+        if not os.path.exists(os.path.join(root, MANIFEST_NAME)):
+            return None
+        return cls(root)
+
+    @classmethod
+    def create(cls, root):
+        """Creates an empty store at `root`, replacing any existing one."""
+        if os.path.exists(root):
+            shutil.rmtree(root)
+        os.makedirs(root)
+        _write_json(os.path.join(root, VOCAB_NAME), [""])
+        _write_json(os.path.join(root, MANIFEST_NAME), {"tables": {table: [] for table in TABLE_SCHEMAS}, "next_segment": 0})
+        return cls(root)
+
+    @classmethod
+    def build_from_csvs(cls, data_dir, root):
+        """(Re)builds a store from the datasets/*.csv files, one segment per table."""
+        import pandas as pd
+        store = cls.create(root)
+        for table, schema in TABLE_SCHEMAS.items():
+            frame = pd.read_csv(os.path.join(data_dir, schema['csv']), dtype=str)
+            store.ingest(table, {column: frame[column].tolist() for column in frame.columns})
+            print(f"Evidence store: loaded {len(frame)} rows into '{table}'.")
+        return store
+
+    # --- Reading ---
+
+    def refresh(self):
+        """Reloads the manifest (and re-maps segments) if another writer has changed it."""
+        path = os.path.join(self.root, MANIFEST_NAME)
+        while True:
+            stat = os.stat(path)
+            version = (stat.st_ino, stat.st_mtime_ns) # os.replace gives every new manifest a new inode
+            if version == self._manifest_version:
+                return self._snapshot
+            with open(path) as f:
+                manifest = json.load(f)
+            with open(os.path.join(self.root, VOCAB_NAME)) as f:
+                vocab = json.load(f)
+            try:
+                tables = {table: [self._open_segment(table, name) for name in manifest['tables'].get(table, [])] for table in TABLE_SCHEMAS}
+                break
+            except FileNotFoundError:
+                # Compacted away since we read the manifest: retry with the new one, if there is one.
+                stat = os.stat(path)
+                if (stat.st_ino, stat.st_mtime_ns) == version:
+                    raise
+        self._snapshot = {"manifest": manifest, "vocab": vocab, "codes": {value: i for i, value in enumerate(vocab)},
+                          "tables": tables, "profiles": self._profile_lookups(tables['profiles'], len(vocab))}
+        self._manifest_version = version
+        return self._snapshot
+
+    def version(self):
+        """A token that changes whenever the store's contents do (every write swaps in a new manifest)."""
+        self.refresh()
+        return self._manifest_version
+
+    def _open_segment(self, table, name):
+        directory = os.path.join(self.root, table, name)
+        schema = TABLE_SCHEMAS[table]
+        segment = {column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode='r')
+                   for column in list(schema['ids']) + list(schema['times'])}
+        if table == 'swipes':
+            segment['card_order'] = np.load(os.path.join(directory, "card_order.npy"), mmap_mode='r')
+            sorted_path = os.path.join(directory, "card_sorted.npy")
+            if os.path.exists(sorted_path):
+                segment['card_sorted'] = np.load(sorted_path, mmap_mode='r')
+            else: # segments written before card_sorted existed
+                segment['card_sorted'] = np.asarray(segment['card'])[segment['card_order']]
+        if 'location' in segment:
+            locations = segment['location']
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(locations)) + 1])
+            segment['blocks'] = {int(locations[start]): (int(start), int(end)) for start, end in zip(starts, np.append(starts[1:], len(locations)))} if len(locations) else {}
+        return segment
+
+    @staticmethod
+    def _profile_lookups(segments, vocab_size):
+        """Dense code -> code lookups from the profiles table; later segments override earlier ones."""
+        lookups = {key: np.zeros(vocab_size, dtype=np.int64) for key in ('entity_of_card', 'entity_of_device', 'face_of_entity', 'name_of_entity', 'external_of_entity')}
+        entities = []
+        for segment in segments:
+            entity = np.asarray(segment['entity'])
+            lookups['entity_of_card'][segment['card']] = entity
+            lookups['entity_of_device'][segment['device']] = entity
+            lookups['face_of_entity'][entity] = segment['face']
+            lookups['name_of_entity'][entity] = segment['name']
+            lookups['external_of_entity'][entity] = np.where(segment['student'] > 0, segment['student'], segment['staff'])
+            entities.append(entity)
+        # Code 0 is "missing": nothing maps to or from it.
+        for lookup in lookups.values():
+            lookup[0] = 0
+        lookups['entities'] = np.unique(np.concatenate(entities)) if entities else np.zeros(0, dtype=np.int64)
+        lookups['entities'] = lookups['entities'][lookups['entities'] > 0]
+        return lookups
+
+    def code(self, value):
+        """Vocabulary code of a string id, or 0 if the store has never seen it."""
+        return self.refresh()['codes'].get(value, 0)
+
+    def decode(self, codes):
+        vocab = self.refresh()['vocab']
+        return [vocab[code] if code else None for code in np.asarray(codes).tolist()]
+
+    def profiles(self):
+        return self.refresh()['profiles']
+
+    def swipes_for_card(self, card_code):
+        """All swipes of one card as {'location', 'time'} columns."""
+        parts = []
+        for segment in self.refresh()['tables']['swipes']:
+            cards = segment['card_sorted']
+            lo, hi = np.searchsorted(cards, card_code, 'left'), np.searchsorted(cards, card_code, 'right')
+            rows = np.sort(segment['card_order'][lo:hi])
+            parts.append({column: segment[column][rows] for column in ('location', 'time')})
+        return self._concat(parts, ('location', 'time'))
+
+    def in_windows(self, table, locations, windows):
+        """Rows at any of `locations` whose time falls inside any of the [start, end] windows."""
+        columns = list(TABLE_SCHEMAS[table]['ids']) + list(TABLE_SCHEMAS[table]['times'])
+        windows = _merge_windows(windows)
+        parts = []
+        for segment in self.refresh()['tables'][table]:
+            for location in set(np.asarray(locations).tolist()):
+                if location in segment['blocks']:
+                    parts.extend(self._window_rows(segment, columns, *segment['blocks'][location], windows))
+        return self._concat(parts, columns)
+
+    def elsewhere_in_windows(self, table, exclude_locations, windows):
+        """Rows at a known location other than `exclude_locations` whose time falls inside any window."""
+        columns = list(TABLE_SCHEMAS[table]['ids']) + list(TABLE_SCHEMAS[table]['times'])
+        excluded = set(np.asarray(exclude_locations).tolist())
+        windows = _merge_windows(windows)
+        parts = []
+        for segment in self.refresh()['tables'][table]:
+            blocks = segment['blocks'].items() if 'blocks' in segment else [(None, (0, len(segment['time'])))]
+            for location, (lo, hi) in blocks:
+                if location in excluded or location == 0: # rows without a location can't be an alibi
+                    continue
+                parts.extend(self._window_rows(segment, columns, lo, hi, windows))
+        return self._concat(parts, columns)
+
+    @staticmethod
+    def _window_rows(segment, columns, lo, hi, windows):
+        """Slices of a time-sorted [lo, hi) block that fall inside each (merged) window."""
+        times = segment['time'][lo:hi]
+        for start, end in windows:
+            first, last = lo + np.searchsorted(times, start, 'left'), lo + np.searchsorted(times, end, 'right')
+            if last > first:
+                yield {column: segment[column][first:last] for column in columns}
+
+    def bookings_covering(self, locations, instants):
+        """Bookings at any of `locations` whose [start, end] contains any of the instants."""
+        columns = list(TABLE_SCHEMAS['bookings']['ids']) + list(TABLE_SCHEMAS['bookings']['times'])
+        instants = np.unique(np.asarray(instants, dtype=np.int64))
+        parts = []
+        for segment in self.refresh()['tables']['bookings']:
+            for location in set(np.asarray(locations).tolist()):
+                if location not in segment['blocks'] or not len(instants):
+                    continue
+                lo, hi = segment['blocks'][location]
+                # Bookings are sorted by start; only those starting by the last instant can cover one.
+                candidates = np.arange(lo, lo + np.searchsorted(segment['start'][lo:hi], instants[-1], 'right'))
+                starts, ends = np.asarray(segment['start'][candidates]), np.asarray(segment['end'][candidates])
+                # A booking covers some instant iff the latest instant up to its end is not before its start.
+                latest = np.searchsorted(instants, ends, 'right') - 1
+                covered = (latest >= 0) & (instants[np.maximum(latest, 0)] >= starts)
+                rows = candidates[covered]
+                parts.append({column: segment[column][rows] for column in columns})
+        return self._concat(parts, columns)
+
+    @staticmethod
+    def _concat(parts, columns):
+        return {column: np.concatenate([part[column] for part in parts]) if parts else np.zeros(0, dtype=np.int64) for column in columns}
+
+    # --- Writing ---
+
+    def ingest(self, table, columns):
+        """
+        Appends rows to a table. `columns` maps CSV column names (see TABLE_SCHEMAS) to equal-length
+        lists; rows without a usable timestamp are dropped. Ids must be strings or integers and
+        timestamps ISO 8601 strings (None/NaN mean missing). Returns the number of rows stored.
+        """
+        if table not in TABLE_SCHEMAS:
+            raise ValueError(f"Unknown evidence table '{table}'. Expected one of: {', '.join(TABLE_SCHEMAS)}.")
+        schema = TABLE_SCHEMAS[table]
+        missing = [csv_column for csv_column in list(schema['ids'].values()) + list(schema['times'].values()) if csv_column not in columns]
+        if missing:
+            raise ValueError(f"Missing columns for '{table}': {', '.join(missing)}.")
+        lengths = {len(columns[csv_column]) for csv_column in list(schema['ids'].values()) + list(schema['times'].values())}
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same number of rows.")
+        for csv_column in schema['times'].values():
+            for value in columns[csv_column]:
+                # A number would be read as epoch nanoseconds, silently placing seconds or milliseconds in 1970.
+                if not (isinstance(value, str) or value is None or (isinstance(value, float) and np.isnan(value))):
+                    raise ValueError(f"'{csv_column}' values must be ISO 8601 strings, got {type(value).__name__} {value!r}.")
+
+        with self._write_lock, _file_lock(os.path.join(self.root, ".lock")):
+            self._manifest_version = None # another process may have written since our last refresh
+            snapshot = self.refresh()
+            vocab, codes = list(snapshot['vocab']), dict(snapshot['codes'])
+
+            def encode(values):
+                out = np.zeros(len(values), dtype=np.int64)
+                for i, value in enumerate(values):
+                    if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+                        value = str(value)
+                    elif value is None or (isinstance(value, float) and np.isnan(value)):
+                        continue # missing stays code 0
+                    elif not isinstance(value, str):
+                        raise ValueError(f"Ids must be strings or integers, got {type(value).__name__} {value!r}.")
+                    if not value:
+                        continue
+                    code = codes.get(value)
+                    if code is None:
+                        code = codes[value] = len(vocab)
+                        vocab.append(value)
+                    out[i] = code
+                return out
+
+            segment = {column: encode(columns[csv_column]) for column, csv_column in schema['ids'].items()}
+            segment.update({column: _parse_times(columns[csv_column]) for column, csv_column in schema['times'].items()})
+            timed = np.ones(len(next(iter(segment.values()))), dtype=bool)
+            for column in schema['times']:
+                timed &= segment[column] != np.iinfo(np.int64).min
+            segment = {column: values[timed] for column, values in segment.items()}
+
+            if len(vocab) != len(snapshot['vocab']):
+                _write_json(os.path.join(self.root, VOCAB_NAME), vocab)
+            manifest = json.loads(json.dumps(snapshot['manifest']))
+            if timed.any():
+                self._write_segment(manifest, table, segment)
+            superseded = []
+            if len(manifest['tables'][table]) > MAX_SEGMENTS_PER_TABLE:
+                superseded = self._compact(manifest, table)
+            _write_json(os.path.join(self.root, MANIFEST_NAME), manifest)
+            # Readers that already mapped these keep their mappings; new readers only see the merged segment.
+            for name in superseded:
+                shutil.rmtree(os.path.join(self.root, table, name), ignore_errors=True)
+            self.refresh()
+            return int(timed.sum())
+
+    def _write_segment(self, manifest, table, segment):
+        order = np.lexsort([segment[key] for key in reversed(TABLE_SCHEMAS[table]['sort'])])
+        segment = {column: values[order] for column, values in segment.items()}
+        if table == 'swipes':
+            segment['card_order'] = np.argsort(segment['card'], kind='stable')
+            segment['card_sorted'] = segment['card'][segment['card_order']]
+
+        name = f"{manifest['next_segment']:06d}"
+        manifest['next_segment'] += 1
+        directory = os.path.join(self.root, table, name)
+        tmp_directory = f"{directory}.tmp"
+        os.makedirs(tmp_directory, exist_ok=True)
+        for column, values in segment.items():
+            np.save(os.path.join(tmp_directory, f"{column}.npy"), values)
+        os.replace(tmp_directory, directory)
+        manifest['tables'][table].append(name)
+
+    def _compact(self, manifest, table):
+        """Merges all of a table's segments into one and returns the names of the segments it replaces."""
+        superseded = manifest['tables'][table]
+        segments = [self._open_segment(table, name) for name in superseded]
+        columns = list(TABLE_SCHEMAS[table]['ids']) + list(TABLE_SCHEMAS[table]['times'])
+        merged = {column: np.concatenate([np.asarray(segment[column]) for segment in segments]) for column in columns}
+        manifest['tables'][table] = []
+        self._write_segment(manifest, table, merged)
+        return superseded
@@ -0,0 +1,134 @@
+"""
+Latency and payload metrics shared by the prediction services.
+
+Handlers wrap each stage of a request in `with metrics.span('stage'):`, and each span
+is recorded in a per-stage latency histogram. Payload sizes, candidate counts and the
+like go through observe(). Everything is exposed in the Prometheus text format by the
+GET /metrics route that install() adds. Under 'serve' mode each worker process keeps
+its own metrics, like the result cache, and reports its pid.
+
+A request sent with the header 'X-Profile: 1' gets its own stage breakdown back in a
+standard Server-Timing response header, e.g. 'features;dur=3.112, serialize;dur=0.402,
+total;dur=4.020' (milliseconds), so a slow production request can be diagnosed
+without redeploying.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+PROFILE_HEADER = 'X-Profile'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = tuple(2**k for k in range(10, 31, 2)) # 1 KiB .. 1 GiB
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+
+class _Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense; not thread-safe on its own."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Named histograms for one service, keyed by an optional 'stage'-style label."""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._families = {} # name -> (description, buckets, label name, {label value: _Histogram})
+        self._lock = threading.Lock()
+
+    def histogram(self, name, description, buckets, label=None):
+        """Declares a histogram family; observe() and span() record into declared families only."""
+        self._families[name] = (description, buckets, label, {})
+
+    def observe(self, name, value, label_value=None):
+        _, buckets, label, series = self._families[name]
+        with self._lock:
+            histogram = series.get(label_value)
+            if histogram is None:
+                histogram = series[label_value] = _Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage):
+        """Times a request stage into the stage histogram and, when profiling, the request's breakdown."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe('stage_seconds', elapsed, stage)
+            if has_request_context() and getattr(g, 'stage_timings', None) is not None:
+                g.stage_timings.append((stage, elapsed))
+
+    def render(self):
+        """All histograms in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (description, buckets, label, series) in self._families.items():
+                full_name = f"{self.namespace}_{name}"
+                lines.append(f"# HELP {full_name} {description}")
+                lines.append(f"# TYPE {full_name} histogram")
+                for label_value, histogram in sorted(series.items(), key=lambda item: str(item[0])):
+                    labels = [f'{label}="{label_value}"'] if label else []
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                        lines.append(f"{full_name}_bucket{{{bucket_labels}}} {cumulative}")
+                    selector = f"{{{','.join(labels)}}}" if labels else ""
+                    lines.append(f"{full_name}_sum{selector} {histogram.sum}")
+                    lines.append(f"{full_name}_count{selector} {histogram.count}")
+        lines.append(f"# HELP {self.namespace}_process_id Worker process that answered this scrape.")
+        lines.append(f"# TYPE {self.namespace}_process_id gauge")
+        lines.append(f"{self.namespace}_process_id {os.getpid()}")
+        return "\n".join(lines) + "\n"
+
+    def install(self, app, endpoints):
+        """
+        Adds the request-level histograms and GET /metrics to a Flask app. Only requests to
+        `endpoints` (view function names) are measured, so health checks and scrapes don't
+        skew the latency figures.
+        """
+        self.histogram('stage_seconds', "Time spent in each request stage.", LATENCY_BUCKETS, label='stage')
+        self.histogram('request_seconds', "Total handling time of prediction requests.", LATENCY_BUCKETS, label='endpoint')
+        self.histogram('payload_bytes', "Size of prediction request bodies.", BYTES_BUCKETS, label='endpoint')
+
+        @app.before_request
+        def start_request():
+            if request.endpoint not in endpoints:
+                return
+            g.request_started = time.perf_counter()
+            g.stage_timings = [] if request.headers.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'yes') else None
+            if request.content_length is not None:
+                self.observe('payload_bytes', request.content_length, request.endpoint)
+
+        @app.after_request
+        def finish_request(response):
+            started = getattr(g, 'request_started', None)
+            if started is None:
+                return response
+            elapsed = time.perf_counter() - started
+            self.observe('request_seconds', elapsed, request.endpoint)
+            if g.stage_timings is not None:
+                timings = {} # a stage that ran several times is reported once, with its total
+                for stage, seconds in g.stage_timings + [('total', elapsed)]:
+                    timings[stage] = timings.get(stage, 0.0) + seconds
+                response.headers['Server-Timing'] = ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items())
+            return response
+
+        @app.route('/metrics', methods=['GET'])
+        def metrics():
+            return app.response_class(self.render(), mimetype='text/plain; version=0.0.4')
@@ -1,17 +1,20 @@
 import os
 import warnings
 import argparse
-import joblib
+import shutil
+import tempfile
+import threading
+import time
 import numpy as np
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import StandardScaler, LabelEncoder
-from sklearn.metrics import accuracy_score
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from artifact_format import ArtifactError, open_bundle, read_manifest, write_bundle, write_manifest
+from metrics import COUNT_BUCKETS, Metrics
+from result_cache import ResultCache, artifact_version, canonical_digest
+from wire_format import PayloadError, column, is_columnar, read_request_body
 from datetime import datetime
-from collections import defaultdict
+from collections import Counter
+import hashlib
 
 # --- Configuration ---
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -21,167 +24,1062 @@ MODEL_PATH = os.path.join(MODEL_DIR, "location_prediction_model.pkl")
 SCALER_PATH = os.path.join(MODEL_DIR, "location_feature_scaler.pkl")
 LOCATION_ENCODER_PATH = os.path.join(MODEL_DIR, "location_encoder.pkl")
 TRANSITION_MATRIX_PATH = os.path.join(MODEL_DIR, "transition_matrix.pkl") # For Journey Analysis
+HISTORY_PATH = os.path.join(MODEL_DIR, "location_history.pkl") # Per-entity counts that 'update' folds new swipes into
+ARTIFACT_FILES = {name: os.path.basename(path) for name, path in [
+    ('model', MODEL_PATH), ('scaler', SCALER_PATH), ('location_encoder', LOCATION_ENCODER_PATH),
+    ('transitions', TRANSITION_MATRIX_PATH), ('history', HISTORY_PATH)]}
+# Serving arrays exported next to the pickles (see artifact_format); 'run' and 'serve' only read these.
+SERVING_FILES = {'forest': "location_forest.npz", 'transitions': "location_transitions.npz"}
+MANIFEST_NAME = "manifest.json"
+FOREST_ARRAYS = ('roots', 'feature', 'threshold', 'left', 'right', 'proba')
+LOCATION_VERSIONS_DIR = os.path.join(MODEL_DIR, "location_versions") # Published artifact sets, one directory each
+CURRENT_VERSION_PATH = os.path.join(LOCATION_VERSIONS_DIR, "CURRENT") # Name of the set the service should load
+VERSIONS_TO_KEEP = 3
+ARTIFACT_RELOAD_INTERVAL = 2.0 # Seconds between checks for a newly published artifact set
 API_PORT = 5002
 FEATURE_COLUMNS = ['hour_of_day', 'day_of_week', 'is_weekend', 'historical_frequency']
+MAX_JOURNEY_HOPS = 6 # Longest run of unknown locations a journey query may span
+MAX_TIMELINE_STEPS = 5000 # Most events and gaps one /predict/location/timeline request may decode
+TIMELINE_SMOOTHING = 1e-3 # Share of probability spread uniformly so unseen moves and locations stay possible
+RESULT_CACHE_MAX_BYTES = 32 * 2**20
+TRAINING_CHUNK_ROWS = 500_000 # Swipe rows read from the CSV at a time
+TRAINING_PARTITION_ROWS = 4_000_000 # Target swipes per on-disk entity partition (each is sorted in memory)
+TRAINING_SAMPLE_PER_LOCATION = 50_000 # Most swipes per location the forest trains on; 0 trains on every swipe, with memory growing with the history
+TRAINING_SEED = 42
+_SPILL_DTYPE = np.dtype([('entity', '<i8'), ('location', '<i8'), ('time', '<i8'), ('row', '<i8')])
+RESULT_CACHE_TTL_SECONDS = 300
 
 # --- Phase 1 & 2: Training Pipeline ---
 
-def train_model():
+def count_transitions(from_codes, to_codes, n_locations):
+    """Counts location-to-location moves into a dense (from, to) matrix over encoded location ids."""
+    flat = np.bincount(from_codes * n_locations + to_codes, minlength=n_locations * n_locations)
+    return flat.reshape(n_locations, n_locations).astype(np.int64)
+
+def _card_entities(profiles_path):
+    """Card id -> entity id, as a Series indexed by card (the last profile wins for a shared card)."""
+    import pandas as pd
+    profiles = pd.read_csv(profiles_path, usecols=['card_id', 'entity_id'], dtype=str).dropna()
+    profiles = profiles.drop_duplicates('card_id', keep='last')
+    return pd.Series(profiles['entity_id'].to_numpy(), index=profiles['card_id'].to_numpy())
+
+class _Vocabulary:
+    """Codes ids in first-seen order, optionally after a list of already-coded ones."""
+
+    def __init__(self, known=()):
+        self.values = list(known)
+        self.index = {value: i for i, value in enumerate(self.values)}
+        self.n_known = len(self.values)
+
+    def codes(self, values):
+        """Codes for an array of ids; only each distinct id goes through Python."""
+        import pandas as pd
+        inverse, uniques = pd.factorize(values)
+        unique_codes = np.empty(len(uniques), dtype=np.int64)
+        for i, value in enumerate(uniques):
+            code = self.index.get(value)
+            if code is None:
+                code = self.index[value] = len(self.values)
+                self.values.append(value)
+            unique_codes[i] = code
+        return unique_codes[inverse]
+
+    def finalize(self):
+        """The final id list (known ids first, new ones sorted) and the old-code -> final-code remap."""
+        new_ids = sorted(self.values[self.n_known:])
+        final = self.values[:self.n_known] + new_ids
+        position = {value: i for i, value in enumerate(final)}
+        return final, np.array([position[value] for value in self.values], dtype=np.int64)
+
+def _read_swipe_chunks(swipes_path, card_entities):
+    """
+    Streams a swipes CSV as (entity ids, location ids, epoch-ns times) arrays per chunk. Ids are
+    read as categoricals, so cards are mapped to entities once per distinct card in the chunk,
+    and rows without an entity, location or parseable timestamp are dropped.
+    """
+    import pandas as pd
+    dtypes = {'card_id': 'category', 'location_id': 'category', 'timestamp': str}
+    for chunk in pd.read_csv(swipes_path, usecols=list(dtypes), dtype=dtypes, chunksize=TRAINING_CHUNK_ROWS):
+        cards = chunk['card_id'].cat
+        # Code -1 (a missing card) picks the trailing None.
+        entity_of_card = np.append(card_entities.reindex(cards.categories).to_numpy(dtype=object), None)
+        entities = entity_of_card[cards.codes.to_numpy()]
+        times = pd.to_datetime(chunk['timestamp'], errors='coerce')
+        keep = pd.notna(entities) & chunk['location_id'].notna().to_numpy() & times.notna().to_numpy()
+        yield entities[keep], chunk['location_id'].to_numpy(dtype=object)[keep], _timestamps_ns(times[keep])
+
+def _keep_reservoir(reservoir, per_location):
+    """Keeps the per_location rows with the smallest random keys for each location (a stratified sample)."""
+    order = np.lexsort((reservoir['key'], reservoir['location']))
+    locations = reservoir['location'][order]
+    group_start = np.searchsorted(locations, locations, side='left')
+    keep = order[np.arange(len(order)) - group_start < per_location]
+    return {name: values[keep] for name, values in reservoir.items()}
+
+def spill_swipes(swipes_path, card_entities, entity_vocab, location_vocab, workdir, sample_per_location=None, seed=TRAINING_SEED):
+    """
+    First pass over a swipes CSV. Each chunk is coded against the vocabularies and appended to
+    one of several on-disk partitions by entity, so a partition holds every swipe of its entities
+    and can later be sorted on its own. Meanwhile up to sample_per_location swipes per location
+    are kept as a uniform reservoir sample for the forest (0: every swipe, None: no sample).
+    Returns (partition paths, reservoir, number of swipes).
+    """
+    n_partitions = max(1, -(-os.path.getsize(swipes_path) // (30 * TRAINING_PARTITION_ROWS))) # ~30 bytes per CSV row
+    paths = [os.path.join(workdir, f"partition-{p}.bin") for p in range(n_partitions)]
+    files = [open(path, 'wb') for path in paths]
+    rng = np.random.default_rng(seed)
+    reservoir = {name: np.empty(0, dtype=np.int64) for name in ('entity', 'location', 'time', 'row')}
+    if sample_per_location:
+        reservoir['key'] = np.empty(0)
+    kept = [] # chunks of sampled records, merged into the reservoir once they outgrow it
+    n_rows = 0
+    try:
+        for entities, locations, times in _read_swipe_chunks(swipes_path, card_entities):
+            records = np.empty(len(times), dtype=_SPILL_DTYPE)
+            records['entity'] = entity_vocab.codes(entities)
+            records['location'] = location_vocab.codes(locations)
+            records['time'] = times
+            records['row'] = np.arange(n_rows, n_rows + len(times))
+            n_rows += len(times)
+            partition = records['entity'] % n_partitions
+            for p in np.unique(partition):
+                records[partition == p].tofile(files[p])
+            if sample_per_location is not None:
+                sample = {'entity': records['entity'], 'location': records['location'], 'time': times, 'row': records['row']}
+                if sample_per_location:
+                    sample['key'] = rng.random(len(records))
+                kept.append(sample)
+                if sample_per_location and sum(len(chunk['row']) for chunk in kept) > len(reservoir['row']) + TRAINING_CHUNK_ROWS:
+                    reservoir, kept = _keep_reservoir(_concat_records([reservoir] + kept), sample_per_location), []
+    finally:
+        for f in files:
+            f.close()
+    reservoir = _concat_records([reservoir] + kept)
+    if sample_per_location:
+        reservoir = _keep_reservoir(reservoir, sample_per_location)
+    return paths, reservoir, n_rows
+
+def _concat_records(parts):
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+def fold_partitions(history, counts, partition_paths, entity_remap, location_remap):
+    """
+    Second pass: loads one entity partition at a time, recodes it to the final vocabularies,
+    sorts it by entity, time and file order, and folds it into the history and transition counts.
+    Partitions hold disjoint entities, so this is the same as folding all swipes at once.
+    Returns the new (history, counts, number of swipes folded, number of late swipes skipped).
+    """
+    n_folded = n_late = 0
+    for path in partition_paths:
+        records = np.fromfile(path, dtype=_SPILL_DTYPE)
+        if not len(records):
+            continue
+        entity_codes, location_codes = entity_remap[records['entity']], location_remap[records['location']]
+        order = np.lexsort((records['row'], records['time'], entity_codes))
+        history, counts, folded, late = fold_swipes(history, counts, entity_codes[order], location_codes[order], records['time'][order])
+        n_folded += folded
+        n_late += late
+    return history, counts, n_folded, n_late
+
+def _last_swipes(history):
+    """
+    (entity, location) codes of the swipes at each entity's last folded time. Histories saved
+    before these were kept only know the single last location.
+    """
+    if 'tie_entity' in history:
+        return history['tie_entity'], history['tie_location']
+    known = np.flatnonzero(np.asarray(history['last_location']) >= 0)
+    return known.astype(np.int64), np.asarray(history['last_location'])[known].astype(np.int64)
+
+def fold_swipes(history, counts, entity_codes, location_codes, times):
+    """
+    Folds swipes, coded against history['entities'] and history['locations'] and sorted by
+    entity then time, into the per-entity location frequency counts, the transition counts and
+    each entity's last swipe. An entity's first new swipe continues the journey from its last
+    folded one. A swipe at exactly the entity's last folded time is skipped only if that same
+    (time, location) swipe was already folded. Swipes older than it arrived late and can't be
+    placed in the journey without retraining, so they are skipped and counted separately.
+    Returns the new (history, counts, number of swipes folded, number of late swipes skipped).
+    """
+    n_entities, n_locations = len(history['entities']), len(history['locations'])
+    last_time = np.full(n_entities, np.iinfo(np.int64).min, dtype=np.int64)
+    last_location = np.full(n_entities, -1, dtype=np.intp)
+    last_time[:len(history['last_time'])] = history['last_time']
+    last_location[:len(history['last_location'])] = history['last_location']
+    grown = np.zeros((n_locations, n_locations), dtype=np.int64)
+    grown[:len(counts), :len(counts)] = counts
+
+    mark = last_time[entity_codes]
+    tie_entity, tie_location = _last_swipes(history)
+    late = times < mark
+    already_folded = (times == mark) & np.isin(entity_codes.astype(np.int64) * n_locations + location_codes,
+                                               tie_entity * n_locations + tie_location)
+    fold = ~(late | already_folded)
+    entity_codes, location_codes, times = entity_codes[fold], location_codes[fold], times[fold]
+    previous_last_time = last_time.copy()
+    first = np.ones(len(entity_codes), dtype=bool)
+    first[1:] = entity_codes[1:] != entity_codes[:-1]
+    previous = np.empty(len(location_codes), dtype=np.intp)
+    previous[1:] = location_codes[:-1]
+    previous[first] = last_location[entity_codes[first]]
+    moved = previous >= 0
+    grown += count_transitions(previous[moved], location_codes[moved], n_locations)
+
+    pair_keys = np.concatenate([history['pair_entity'] * n_locations + history['pair_location'],
+                                entity_codes.astype(np.int64) * n_locations + location_codes])
+    keys, inverse = np.unique(pair_keys, return_inverse=True)
+    pair_counts = np.bincount(inverse, weights=np.concatenate([history['pair_count'], np.ones(len(entity_codes))])).astype(np.int64)
+
+    last = np.ones(len(entity_codes), dtype=bool)
+    last[:-1] = entity_codes[1:] != entity_codes[:-1]
+    last_time[entity_codes[last]] = times[last]
+    last_location[entity_codes[last]] = location_codes[last]
+    # An entity's earlier last swipes still count as folded at its last time unless it moved on.
+    still_last = last_time[tie_entity] == previous_last_time[tie_entity]
+    at_last = times == last_time[entity_codes]
+    tie_keys = np.unique(np.concatenate([tie_entity[still_last] * n_locations + tie_location[still_last],
+                                         entity_codes[at_last].astype(np.int64) * n_locations + location_codes[at_last]]))
+    return {
+        "locations": list(history['locations']), "entities": list(history['entities']),
+        "pair_entity": keys // n_locations, "pair_location": keys % n_locations, "pair_count": pair_counts,
+        "last_time": last_time, "last_location": last_location,
+        "tie_entity": tie_keys // n_locations, "tie_location": tie_keys % n_locations,
+        "folded_files": list(history.get('folded_files', [])),
+    }, grown, len(entity_codes), int(late.sum())
+
+def empty_history(locations, entities):
+    return {
+        "locations": list(locations), "entities": list(entities),
+        "pair_entity": np.empty(0, dtype=np.int64), "pair_location": np.empty(0, dtype=np.int64), "pair_count": np.empty(0, dtype=np.int64),
+        "last_time": np.empty(0, dtype=np.int64), "last_location": np.empty(0, dtype=np.intp),
+        "tie_entity": np.empty(0, dtype=np.int64), "tie_location": np.empty(0, dtype=np.int64),
+        "folded_files": [],
+    }
+
+def _file_digest(path):
+    """Content hash of a swipes file, recorded in the history so the same file isn't folded twice."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _timestamps_ns(timestamps):
+    return timestamps.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+def current_artifact_dir():
+    """The directory of the published artifact set, or MODEL_DIR for artifacts saved before versioning."""
+    try:
+        with open(CURRENT_VERSION_PATH) as f:
+            return os.path.join(LOCATION_VERSIONS_DIR, f.read().strip())
+    except FileNotFoundError:
+        return MODEL_DIR
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def _forest_arrays(model, scaler, location_encoder):
+    """The 'forest' serving bundle: the compiled forest, the scaler parameters and the class names."""
+    return {
+        **compile_forest(model),
+        "scaler_mean": scaler.mean_, "scaler_scale": scaler.scale_,
+        "class_names": np.asarray(location_encoder.inverse_transform(model.classes_)).astype(str),
+    }
+
+def _transition_arrays(transitions):
+    """The 'transitions' serving bundle: location names and raw transition counts."""
+    transition_model = build_transition_model(transitions)
+    return {"locations": np.asarray(transition_model['locations']).astype(str), "counts": transition_model['counts'].astype(np.int64)}
+
+def publish_artifacts(objects, linked_from=None):
     """
-    Loads all raw CSV data, engineers features, trains a model for historical patterns,
-    creates a journey transition matrix, and saves all artifacts.
+    Writes a new versioned artifact set and makes it the current one. `objects` maps ARTIFACT_FILES
+    names to the objects to save; the other artifacts are hard-linked (or copied) from `linked_from`.
+    The serving bundles and their manifest are exported from the new objects, linked when they
+    are unchanged, or exported from the linked pickles of a set saved before the manifest existed.
+    The set is written to a staging directory and renamed into place before the CURRENT pointer is
+    atomically replaced, so a running service only ever sees complete sets.
     """
+    import joblib
+    previous = read_manifest(os.path.join(linked_from, MANIFEST_NAME), 'location', featureColumns=FEATURE_COLUMNS) if linked_from else None
+    os.makedirs(LOCATION_VERSIONS_DIR, exist_ok=True)
+    version = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    staging = os.path.join(LOCATION_VERSIONS_DIR, f".staging-{version}")
+    os.makedirs(staging)
+    for name, filename in ARTIFACT_FILES.items():
+        target = os.path.join(staging, filename)
+        if name in objects:
+            joblib.dump(objects[name], target)
+        elif linked_from is not None and os.path.exists(os.path.join(linked_from, filename)):
+            _link_or_copy(os.path.join(linked_from, filename), target)
+
+    bundles = {}
+    for name, filename in SERVING_FILES.items():
+        target = os.path.join(staging, filename)
+        changed = ('model', 'scaler', 'location_encoder') if name == 'forest' else ('transitions',)
+        if previous is not None and name in previous['bundles'] and not any(key in objects for key in changed):
+            _link_or_copy(os.path.join(linked_from, previous['bundles'][name]['file']), target)
+            bundles[name] = previous['bundles'][name]
+            continue
+        loaded = {key: objects[key] if key in objects else joblib.load(os.path.join(staging, ARTIFACT_FILES[key])) for key in changed}
+        bundles[name] = write_bundle(target, _forest_arrays(**loaded) if name == 'forest' else _transition_arrays(**loaded))
+    write_manifest(os.path.join(staging, MANIFEST_NAME), 'location', bundles, featureColumns=FEATURE_COLUMNS, createdAt=version)
+
+    directory = os.path.join(LOCATION_VERSIONS_DIR, version)
+    os.rename(staging, directory)
+    with open(f"{CURRENT_VERSION_PATH}.tmp", 'w') as f:
+        f.write(version)
+    os.replace(f"{CURRENT_VERSION_PATH}.tmp", CURRENT_VERSION_PATH)
+
+    # Keep a few older sets around: a service may still be loading the previous one.
+    published = sorted(name for name in os.listdir(LOCATION_VERSIONS_DIR) if not name.startswith('.') and name != "CURRENT" and name != version)
+    for name in published[:max(0, len(published) - (VERSIONS_TO_KEEP - 1))]:
+        shutil.rmtree(os.path.join(LOCATION_VERSIONS_DIR, name), ignore_errors=True)
+    return directory
+
+def training_features(history, reservoir):
+    """FEATURE_COLUMNS rows and location ids for the sampled swipes, in entity-then-time order."""
+    import pandas as pd
+    order = np.lexsort((reservoir['row'], reservoir['time'], reservoir['entity']))
+    entity, location, times = reservoir['entity'][order], reservoir['location'][order], reservoir['time'][order]
+
+    # historical_frequency: the share of the entity's swipes made at this location, over all swipes.
+    n_locations = len(history['locations'])
+    pair_keys = history['pair_entity'] * n_locations + history['pair_location']
+    pair_counts = history['pair_count'][np.searchsorted(pair_keys, entity * n_locations + location)]
+    entity_totals = np.bincount(history['pair_entity'], weights=history['pair_count'], minlength=len(history['entities']))
+
+    timestamps = pd.DatetimeIndex(times.view('datetime64[ns]'))
+    X = pd.DataFrame({
+        'hour_of_day': timestamps.hour, 'day_of_week': timestamps.dayofweek,
+        'is_weekend': (timestamps.dayofweek >= 5).astype(int),
+        'historical_frequency': pair_counts / entity_totals[entity],
+    }, columns=FEATURE_COLUMNS)
+    return X, np.asarray(history['locations'], dtype=object)[location]
+
+def train_model(workers=None, sample_per_location=TRAINING_SAMPLE_PER_LOCATION):
+    """
+    Streams the swipes CSV, builds the journey transition matrix and per-entity history, trains
+    the historical pattern model, and saves all artifacts. Swipes are read in chunks and sorted
+    one entity partition at a time on disk, and the forest trains on a stratified sample of at
+    most sample_per_location swipes per location, so peak memory depends on the chunk, partition
+    and sample sizes rather than on the length of the history. Sampled swipes are weighted by
+    their location's total over its sample size, so the forest still learns the full history's
+    location priors. sample_per_location=0 trains on every swipe instead.
+    """
+    import pandas as pd
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import LabelEncoder, StandardScaler
     print("\n--- Starting Location Prediction Model Training ---")
-    
+
     try:
-        profiles_df = pd.read_csv(os.path.join(DATA_DIR, 'student_or_staff_profiles.csv'), dtype=str)
-        swipes_df = pd.read_csv(os.path.join(DATA_DIR, 'campus_card_swipes.csv'), dtype=str)
+        card_entities = _card_entities(os.path.join(DATA_DIR, 'student_or_staff_profiles.csv'))
+        swipes_path = os.path.join(DATA_DIR, 'campus_card_swipes.csv')
+        entity_vocab, location_vocab = _Vocabulary(), _Vocabulary()
+        with tempfile.TemporaryDirectory(prefix="location-train-") as workdir:
+            partitions, reservoir, n_swipes = spill_swipes(swipes_path, card_entities, entity_vocab, location_vocab, workdir, sample_per_location)
+
+            # --- Journey Analysis: Build Transition Matrix ---
+            # The transition counts are kept with per-entity location counts and each entity's last
+            # swipe, so 'update' can later fold in new swipes without re-reading this history.
+            print(f"Building journey transition matrix from {n_swipes} swipes...")
+            entities, entity_remap = entity_vocab.finalize()
+            locations, location_remap = location_vocab.finalize()
+            history, transition_counts, _, _ = fold_partitions(empty_history(locations, entities), np.zeros((0, 0), dtype=np.int64),
+                                                               partitions, entity_remap, location_remap)
+            history['folded_files'] = [_file_digest(swipes_path)]
     except FileNotFoundError as e:
         print(f"Error: Required CSV not found - {e}. Aborting training.")
         return
-
-    # --- Journey Analysis: Build Transition Matrix ---
-    print("Building journey transition matrix...")
-    card_to_entity = {row['card_id']: row['entity_id'] for _, row in profiles_df.dropna(subset=['card_id', 'entity_id']).iterrows()}
-    swipes_df['entity_id'] = swipes_df['card_id'].map(card_to_entity)
-    swipes_df = swipes_df.dropna(subset=['entity_id', 'timestamp', 'location_id'])
-    swipes_df['timestamp'] = pd.to_datetime(swipes_df['timestamp'])
-    swipes_df = swipes_df.sort_values(by=['entity_id', 'timestamp'])
-
-    transitions = defaultdict(lambda: defaultdict(int))
-    for _, group in swipes_df.groupby('entity_id'):
-        locations = group['location_id'].tolist()
-        for i in range(len(locations) - 1):
-            transitions[locations[i]][locations[i+1]] += 1
-    
-    joblib.dump(dict(transitions), TRANSITION_MATRIX_PATH)
-    print(f"Transition matrix saved to '{TRANSITION_MATRIX_PATH}'.")
+    transitions = {"locations": list(locations), "counts": transition_counts}
 
     # --- ML Model Training (Historical Patterns) ---
-    print("Training historical pattern model...")
-    swipes_df['hour_of_day'] = swipes_df['timestamp'].dt.hour
-    swipes_df['day_of_week'] = swipes_df['timestamp'].dt.dayofweek
-    swipes_df['is_weekend'] = (swipes_df['day_of_week'] >= 5).astype(int)
-
-    location_counts = swipes_df.groupby(['entity_id', 'location_id']).size().reset_index(name='counts')
-    total_counts = location_counts.groupby('entity_id')['counts'].sum().reset_index(name='total')
-    location_counts = pd.merge(location_counts, total_counts, on='entity_id')
-    location_counts['historical_frequency'] = location_counts['counts'] / location_counts['total']
-    
-    features_df = pd.merge(swipes_df, location_counts, on=['entity_id', 'location_id'])
-    X = features_df[FEATURE_COLUMNS]
-    y = features_df['location_id']
+    reservoir = {**reservoir, 'entity': entity_remap[reservoir['entity']], 'location': location_remap[reservoir['location']]}
+    print(f"Training historical pattern model on {len(reservoir['row'])} {'sampled ' if sample_per_location else ''}swipes...")
+    X, y = training_features(history, reservoir)
+    weights = np.ones(len(y))
+    if sample_per_location:
+        # Each sampled swipe stands for (location total / location sample size) swipes.
+        n_locations = len(history['locations'])
+        location_totals = np.bincount(history['pair_location'], weights=history['pair_count'], minlength=n_locations)
+        sample_sizes = np.bincount(reservoir['location'], minlength=n_locations)
+        weights = (location_totals / np.maximum(sample_sizes, 1))[pd.Index(history['locations']).get_indexer(y)]
+    # Unit weights still change how scikit-learn draws the bootstrap, so only pass them when some location was sampled down.
+    sampled_down = bool(np.any(weights != 1))
 
     location_encoder = LabelEncoder().fit(y)
     y_encoded = location_encoder.transform(y)
     
-    X_train, X_test, y_train, y_test = train_test_split(X, y_encoded, test_size=0.2, random_state=42, stratify=y_encoded)
+    X_train, X_test, y_train, y_test, weights_train, _ = train_test_split(X, y_encoded, weights, test_size=0.2, random_state=42, stratify=y_encoded)
     scaler = StandardScaler().fit(X_train)
     X_train_scaled = scaler.transform(X_train)
     
-    model = RandomForestClassifier(n_estimators=100, random_state=42)
-    model.fit(X_train_scaled, y_train)
+    model = RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=workers or -1)
+    model.fit(X_train_scaled, y_train, sample_weight=weights_train if sampled_down else None)
     
-    os.makedirs(MODEL_DIR, exist_ok=True)
-    joblib.dump(model, MODEL_PATH)
-    joblib.dump(scaler, SCALER_PATH)
-    joblib.dump(location_encoder, LOCATION_ENCODER_PATH)
-    print("Model, scaler, and encoder saved.")
+    directory = publish_artifacts({"model": model, "scaler": scaler, "location_encoder": location_encoder,
+                                   "transitions": transitions, "history": history})
+    print(f"Model, scaler, encoder, transition matrix and history saved to '{directory}'.")
     print("--- Training Complete ---")
 
-# --- Phase 3: API Deployment ---
+def update_model(swipes_path):
+    """
+    Folds new swipes into the current artifact set's transition counts and per-entity history
+    and publishes the result as a new version, which running services pick up without a restart.
+    The swipes are streamed the same way as in training. The forest, scaler and encoder are
+    carried over unchanged; 'train' rebuilds everything.
+    """
+    import joblib
+    print("\n--- Updating Location Prediction Artifacts ---")
+    base_dir = current_artifact_dir()
+    try:
+        history = joblib.load(os.path.join(base_dir, ARTIFACT_FILES['history']))
+        transitions = joblib.load(os.path.join(base_dir, ARTIFACT_FILES['transitions']))
+    except FileNotFoundError as e:
+        print(f"Error: No swipe history in '{base_dir}' ({e}). Run 'python predict_location.py train' first.")
+        return
+    if list(transitions.get('locations', [])) != history['locations']:
+        print(f"Error: The transition matrix in '{base_dir}' doesn't match its history. Run 'python predict_location.py train' first.")
+        return
+
+    try:
+        file_digest = _file_digest(swipes_path)
+        if file_digest in history.get('folded_files', []):
+            print(f"'{swipes_path}' has already been folded into these artifacts; they are unchanged.")
+            return
+        card_entities = _card_entities(os.path.join(DATA_DIR, 'student_or_staff_profiles.csv'))
+        entity_vocab, location_vocab = _Vocabulary(history['entities']), _Vocabulary(history['locations'])
+        with tempfile.TemporaryDirectory(prefix="location-update-") as workdir:
+            partitions, _, n_swipes = spill_swipes(swipes_path, card_entities, entity_vocab, location_vocab, workdir)
+            entities, entity_remap = entity_vocab.finalize()
+            locations, location_remap = location_vocab.finalize()
+            history = {**history, "locations": locations, "entities": entities}
+            history, transition_counts, n_folded, n_late = fold_partitions(history, transitions['counts'], partitions, entity_remap, location_remap)
+    except FileNotFoundError as e:
+        print(f"Error: Required CSV not found - {e}. Aborting update.")
+        return
+    print(f"Folded {n_folded} new swipes ({n_swipes - n_folded - n_late} already folded were skipped).")
+    if n_late:
+        print(f"Warning: {n_late} swipes are older than their entity's last folded swipe and were NOT folded. "
+              f"Run 'python predict_location.py train' with the full history to include them.")
+    history['folded_files'] = history.get('folded_files', []) + [file_digest]
+    if n_folded == 0:
+        print("Nothing new to fold; the current artifacts are unchanged.")
+        return
+    directory = publish_artifacts({"transitions": {"locations": history['locations'], "counts": transition_counts}, "history": history},
+                                  linked_from=base_dir)
+    print(f"Updated artifacts published to '{directory}'.")
+
+# --- Phase 3: Compiled Inference ---
+
+def compile_forest(forest):
+    """
+    Flattens a fitted RandomForestClassifier into contiguous node arrays (feature, threshold,
+    children and per-node class distributions) so all rows and trees are traversed together.
+    """
+    from sklearn import __version__ as sklearn_version
+    trees = [estimator.tree_ for estimator in forest.estimators_]
+    roots = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+
+    def children(side, offset):
+        return np.where(side >= 0, side + offset, -1)
+
+    value = np.concatenate([tree.value[:, 0, :] for tree in trees])
+    if tuple(int(part) for part in sklearn_version.split('.')[:2]) < (1, 4):
+        # Older trees store weighted counts and predict_proba normalises them per call;
+        # from 1.4 on they already hold the fractions predict_proba returns.
+        normalizer = value.sum(axis=1)
+        normalizer[normalizer == 0.0] = 1.0
+        value = value / normalizer[:, np.newaxis]
+    return {
+        "roots": roots.astype(np.intp),
+        "feature": np.concatenate([np.maximum(tree.feature, 0) for tree in trees]).astype(np.intp),
+        "threshold": np.concatenate([tree.threshold for tree in trees]),
+        "left": np.concatenate([children(tree.children_left, offset) for tree, offset in zip(trees, roots)]).astype(np.intp),
+        "right": np.concatenate([children(tree.children_right, offset) for tree, offset in zip(trees, roots)]).astype(np.intp),
+        "proba": value,
+    }
+
+def forest_predict_proba(forest, X):
+    """Batched equivalent of RandomForestClassifier.predict_proba for a compiled forest."""
+    X = np.asarray(X, dtype=np.float32) # sklearn evaluates trees on float32 inputs
+    rows = np.arange(len(X))[:, np.newaxis]
+    nodes = np.broadcast_to(forest['roots'], (len(X), len(forest['roots']))).copy()
+    while True:
+        left = forest['left'][nodes]
+        internal = left >= 0
+        if not internal.any():
+            break
+        go_left = X[rows, forest['feature'][nodes]] <= forest['threshold'][nodes]
+        nodes = np.where(internal, np.where(go_left, left, forest['right'][nodes]), nodes)
+
+    # Accumulate tree by tree, in order, exactly like sklearn does.
+    proba = np.zeros((len(X), forest['proba'].shape[1]))
+    for tree_index in range(nodes.shape[1]):
+        proba += forest['proba'][nodes[:, tree_index]]
+    proba /= nodes.shape[1]
+    return proba
+
+def build_transition_model(transitions):
+    """
+    Row-normalises persisted transition counts into P[from, to] and precomputes P**k so a
+    journey through k unknown hops is scored with a single row-times-column product.
+    Also accepts the older {from: {to: count}} dict format.
+    """
+    if 'counts' not in transitions:
+        names = sorted(set(transitions) | {to for row in transitions.values() for to in row})
+        index = {name: i for i, name in enumerate(names)}
+        counts = np.zeros((len(names), len(names)), dtype=np.int64)
+        for from_name, row in transitions.items():
+            for to_name, count in row.items():
+                counts[index[from_name], index[to_name]] = count
+        transitions = {"locations": names, "counts": counts}
+
+    counts = np.asarray(transitions['counts'])
+    totals = counts.sum(axis=1, keepdims=True)
+    probabilities = np.divide(counts, totals, out=np.zeros(counts.shape), where=totals > 0)
+    powers = [np.eye(len(counts)), probabilities]
+    for _ in range(MAX_JOURNEY_HOPS):
+        powers.append(powers[-1] @ probabilities)
+    return {
+        "locations": list(transitions['locations']),
+        "index": {name: i for i, name in enumerate(transitions['locations'])},
+        "counts": counts,
+        "powers": powers,
+    }
+
+def journey_scores(transition_model, loc_before, loc_after, hops=1):
+    """
+    Scores every location as the unknown stop between loc_before and loc_after. With k hops the
+    score averages, over each position j, the chance of being there after j steps from the start
+    and reaching the end k+1-j steps later. For k=1 this is P[A, B] * P[B, C].
+    """
+    index, powers = transition_model['index'], transition_model['powers']
+    if loc_before not in index or loc_after not in index:
+        return np.zeros(len(index))
+    a, c = index[loc_before], index[loc_after]
+    return sum(powers[j][a] * powers[hops + 1 - j][:, c] for j in range(1, hops + 1)) / hops
+
+def _serving_artifacts(forest, transitions, version, directory):
+    """Checks serving arrays against FEATURE_COLUMNS and each other and precomputes everything predict() needs."""
+    n_features = len(FEATURE_COLUMNS)
+    if forest['scaler_mean'].shape != (n_features,) or forest['scaler_scale'].shape != (n_features,):
+        raise ArtifactError(f"The scaler in '{directory}' has {len(forest['scaler_mean'])} features; FEATURE_COLUMNS has {n_features}.")
+    if len(forest['feature']) and forest['feature'].max() >= n_features:
+        raise ArtifactError(f"The forest in '{directory}' splits on features FEATURE_COLUMNS doesn't have.")
+    if forest['proba'].shape[1] != len(forest['class_names']):
+        raise ArtifactError(f"The forest in '{directory}' predicts {forest['proba'].shape[1]} classes but has {len(forest['class_names'])} class names.")
+    if transitions['counts'].shape != (len(transitions['locations']),) * 2:
+        raise ArtifactError(f"The transition matrix in '{directory}' doesn't match its {len(transitions['locations'])} locations.")
+    return {
+        "transitions": build_transition_model({"locations": transitions['locations'].tolist(), "counts": transitions['counts']}),
+        "forest": {name: forest[name] for name in FOREST_ARRAYS},
+        "scaler_mean": forest['scaler_mean'],
+        "scaler_scale": forest['scaler_scale'],
+        "class_names": forest['class_names'].tolist(),
+        "version": version,
+        "directory": directory,
+    }
+
+def load_artifacts(directory=None):
+    """
+    Loads an artifact set (default: the current one) from its memory-mapped serving bundles,
+    without importing scikit-learn. Sets saved before the manifest existed are unpickled instead.
+    Raises ArtifactError if the set doesn't match FEATURE_COLUMNS or is inconsistent.
+    """
+    directory = directory or current_artifact_dir()
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    manifest = read_manifest(manifest_path, 'location', featureColumns=FEATURE_COLUMNS)
+    if manifest is None:
+        return _load_pickled_artifacts(directory)
+    forest = open_bundle(directory, manifest, 'forest', required=FOREST_ARRAYS + ('scaler_mean', 'scaler_scale', 'class_names'))
+    transitions = open_bundle(directory, manifest, 'transitions', required=('locations', 'counts'))
+    version = artifact_version([manifest_path] + [os.path.join(directory, bundle['file']) for bundle in manifest['bundles'].values()])
+    return _serving_artifacts(forest, transitions, version, directory)
+
+def _load_pickled_artifacts(directory):
+    import joblib
+    paths = {name: os.path.join(directory, filename) for name, filename in ARTIFACT_FILES.items()}
+    model = joblib.load(paths['model'])
+    scaler = joblib.load(paths['scaler'])
+    feature_names = getattr(scaler, 'feature_names_in_', None)
+    if feature_names is not None and list(feature_names) != FEATURE_COLUMNS:
+        raise ArtifactError(f"The scaler in '{directory}' was fitted on {list(feature_names)}; FEATURE_COLUMNS is {FEATURE_COLUMNS}.")
+    version = artifact_version([paths[name] for name in ('model', 'scaler', 'location_encoder', 'transitions')])
+    return _serving_artifacts(_forest_arrays(model, scaler, joblib.load(paths['location_encoder'])),
+                              _transition_arrays(joblib.load(paths['transitions'])), version, directory)
+
+def export_artifacts():
+    """Publishes the current artifact set again with serving bundles, e.g. for a set trained before they existed."""
+    base_dir = current_artifact_dir()
+    try:
+        directory = publish_artifacts({}, linked_from=base_dir)
+    except FileNotFoundError as e:
+        print(f"Error: Missing artifact in '{base_dir}' ({e}). Run 'python predict_location.py train' first.")
+        return
+    print(f"Serving bundles for '{base_dir}' published to '{directory}'.")
+
+# --- Phase 4: API Deployment ---
 app = Flask(__name__)
 CORS(app)
 
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_SECONDS)
+
+metrics = Metrics('ethos_location')
+metrics.install(app, endpoints={'predict', 'predict_batch', 'predict_timeline'})
+metrics.histogram('locations', "Candidate locations per request.", COUNT_BUCKETS, label='endpoint')
+metrics.histogram('history_events', "Rows of historicalActivity per request.", COUNT_BUCKETS, label='endpoint')
+metrics.histogram('gaps', "Gaps (queries or unknown timeline steps) filled per request.", COUNT_BUCKETS, label='endpoint')
+
 try:
-    model = joblib.load(MODEL_PATH)
-    scaler = joblib.load(SCALER_PATH)
-    location_encoder = joblib.load(LOCATION_ENCODER_PATH)
-    transitions = joblib.load(TRANSITION_MATRIX_PATH)
+    artifacts = load_artifacts()
+    result_cache.set_version(artifacts['version'])
     print(f"\nAll location prediction artifacts loaded successfully. API is ready.")
 except FileNotFoundError:
-    model, scaler, location_encoder, transitions = None, None, None, None
+    artifacts = None
+except ArtifactError as e:
+    print(f"\nLocation prediction artifacts can't be used: {e}")
+    artifacts = None
+_reload_lock = threading.Lock()
+_last_reload_check = time.monotonic()
 
-@app.route('/predict/location', methods=['POST'])
-# In location_prediction_service.py
+def current_artifacts():
+    """
+    The loaded artifacts, after swapping in a newly published set if one appeared. Checks at
+    most every ARTIFACT_RELOAD_INTERVAL seconds; while one request loads the new set, others
+    keep being answered from the old one. Handlers take one reference per request, so a swap
+    never mixes two sets within a response.
+    """
+    global artifacts, _last_reload_check
+    if time.monotonic() - _last_reload_check < ARTIFACT_RELOAD_INTERVAL or not _reload_lock.acquire(blocking=False):
+        return artifacts
+    try:
+        _last_reload_check = time.monotonic()
+        directory = current_artifact_dir()
+        if artifacts is None or directory != artifacts['directory']:
+            try:
+                loaded = load_artifacts(directory)
+            except (OSError, EOFError, ValueError) as e:
+                print(f"Could not load artifacts from '{directory}': {e}. Keeping the current ones.")
+            else:
+                artifacts = loaded
+                result_cache.set_version(loaded['version'])
+                print(f"Loaded location prediction artifacts from '{directory}'.")
+    finally:
+        _reload_lock.release()
+    return artifacts
 
-@app.route('/predict/location', methods=['POST'])
-def predict():
-    if not model or not scaler or not location_encoder or not transitions:
-        return jsonify({"error": "Model artifacts not loaded. Please train the model first."}), 500
+def _parse_gap_query(query):
+    """Validates one gap query and returns (start_time, loc_before, loc_after, hops); raises ValueError."""
+    hops = query.get('hops', 1)
+    if isinstance(hops, bool) or not isinstance(hops, int) or not 1 <= hops <= MAX_JOURNEY_HOPS:
+        raise ValueError(f"Invalid 'hops': must be an integer between 1 and {MAX_JOURNEY_HOPS}.")
+    try:
+        start_time = datetime.fromisoformat(query['startTime'].replace('Z', '+00:00'))
+        return start_time, query['locationBefore']['name'], query['locationAfter']['name'], hops
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise ValueError(f"Invalid gap query: {e}")
 
-    data = request.get_json()
-    if not data or not all(k in data for k in ['startTime', 'historicalActivity', 'allLocations', 'locationBefore', 'locationAfter']):
-        return jsonify({"error": "Invalid request body: Missing required keys."}), 400
+def _historical_frequencies(historical_activity, all_locations):
+    """Share of the user's past activity at each location, in allLocations order."""
+    with metrics.span('history_frequencies'):
+        return _count_frequencies(historical_activity, all_locations)
 
-    start_time = datetime.fromisoformat(data['startTime'].replace('Z', '+00:00'))
-    loc_before = data['locationBefore']['name']
-    loc_after = data['locationAfter']['name']
+def _count_frequencies(historical_activity, all_locations):
+    if is_columnar(historical_activity):
+        location_ids = column(historical_activity.get('locationId', [])).tolist()
+        location_counts, total_events = Counter(location_ids), len(location_ids)
+    else:
+        location_counts = Counter(activity.get('locationId') for activity in historical_activity)
+        total_events = len(historical_activity)
+    return np.array([location_counts.get(location['id'], 0) / total_events if total_events > 0 else 0 for location in all_locations], dtype=float)
 
-    # --- 1. Historical Model Prediction (This part is correct) ---
-    history_df = pd.DataFrame(data['historicalActivity'])
-    location_counts = history_df.groupby('locationId').size().reset_index(name='counts')
-    total_events = len(history_df)
-    location_counts['historical_frequency'] = location_counts['counts'] / total_events if total_events > 0 else 0
-    
-    feature_vectors, historical_scores = [], {}
-    for location in data['allLocations']:
-        freq_row = location_counts[location_counts['locationId'] == location['id']]
-        frequency = freq_row['historical_frequency'].iloc[0] if not freq_row.empty else 0
-        feature_vectors.append({'hour_of_day': start_time.hour, 'day_of_week': start_time.weekday(), 'is_weekend': 1 if start_time.weekday() >= 5 else 0, 'historical_frequency': frequency})
-    
-    X_live_scaled = scaler.transform(pd.DataFrame(feature_vectors))
-    probabilities = model.predict_proba(X_live_scaled)
+def _live_features(start_time, frequencies):
+    """One FEATURE_COLUMNS row per candidate location for a gap starting at start_time."""
+    X_live = np.empty((len(frequencies), len(FEATURE_COLUMNS)))
+    X_live[:, 0] = start_time.hour
+    X_live[:, 1] = start_time.weekday()
+    X_live[:, 2] = 1 if start_time.weekday() >= 5 else 0
+    X_live[:, 3] = frequencies
+    return X_live
 
-    for i, loc_id_encoded in enumerate(model.classes_):
-        loc_name = location_encoder.inverse_transform([loc_id_encoded])[0]
-        historical_scores[loc_name] = probabilities[:, i].sum()
-    
-    # --- 2. Journey Model Prediction (This part is correct) ---
-    journey_scores = {}
-    total_transitions = sum(transitions.get(loc_before, {}).values())
-    if total_transitions > 0:
-        for loc_B, count in transitions.get(loc_before, {}).items():
-            next_transitions = transitions.get(loc_B, {})
-            if loc_after in next_transitions:
-                prob_A_to_B = count / total_transitions
-                prob_B_to_C = next_transitions[loc_after] / sum(next_transitions.values())
-                journey_scores[loc_B] = prob_A_to_B * prob_B_to_C
-
-    # --- 3. Hybrid Scoring (This part is correct) ---
-    final_scores = {}
-    all_loc_names = {loc['name'] for loc in data['allLocations']}
-    for loc_name in all_loc_names:
-        hist_score = historical_scores.get(loc_name, 0)
-        jour_score = journey_scores.get(loc_name, 0)
-        final_scores[loc_name] = (jour_score * 0.7) + (hist_score * 0.3)
+def _historical_probabilities(current, X_live):
+    with metrics.span('historical'):
+        X_live_scaled = (X_live - current['scaler_mean']) / current['scaler_scale']
+        return forest_predict_proba(current['forest'], X_live_scaled)
+
+def _predict_gap(current, all_locations, probabilities, loc_before, loc_after, hops):
+    """Combines the historical and journey models of an artifact set into the response for one gap."""
+    # --- 1. Historical Model Prediction ---
+    with metrics.span('historical'):
+        historical_scores = {}
+        for i, loc_name in enumerate(current['class_names']):
+            historical_scores[loc_name] = probabilities[:, i].sum()
+
+    # --- 2. Journey Model Prediction ---
+    with metrics.span('journey'):
+        transition_model = current['transitions']
+        journey = journey_scores(transition_model, loc_before, loc_after, hops)
+
+    # --- 3. Hybrid Scoring ---
+    with metrics.span('hybrid_scoring'):
+        final_scores = {}
+        all_loc_names = {loc['name'] for loc in all_locations}
+        for loc_name in all_loc_names:
+            hist_score = historical_scores.get(loc_name, 0)
+            jour_index = transition_model['index'].get(loc_name)
+            jour_score = journey[jour_index] if jour_index is not None else 0
+            final_scores[loc_name] = (jour_score * 0.7) + (hist_score * 0.3)
 
     if not final_scores or all(score == 0 for score in final_scores.values()):
-        return jsonify({"prediction": None, "reason": "Not enough historical data to predict a likely journey."})
+        return {"prediction": None, "reason": "Not enough historical data to predict a likely journey."}
 
-    # **THE FIX:** The result of max() is the location NAME (a string).
+    # The result of max() is the location NAME (a string).
     best_location_name = max(final_scores, key=lambda k: final_scores[k])
     confidence = final_scores[best_location_name]
-    
+
     # Find the full location object that has the matching name. Do NOT convert to int.
-    predicted_location = next((loc for loc in data['allLocations'] if loc['name'] == best_location_name), None)
-    
+    predicted_location = next((loc for loc in all_locations if loc['name'] == best_location_name), None)
+
     reason = f"The most likely path from '{loc_before}' to '{loc_after}' is via this location. Model confidence: {confidence*100:.0f}%."
+    return {"prediction": predicted_location, "reason": reason}
+
+def _gap_cache_key(current, start_time, loc_before, loc_after, hops, frequencies, all_locations):
+    """Everything a gap's response depends on: the hour and weekday, not the exact start time."""
+    frequency_digest = hashlib.blake2b(frequencies.tobytes(), digest_size=16).hexdigest()
+    return canonical_digest('location', start_time.hour, start_time.weekday(), loc_before, loc_after, hops,
+                            frequency_digest, all_locations, current['version'])
+
+def transition_probabilities(transition_model):
+    """P[from, to] with rows that were never left made uniform and every move smoothed by TIMELINE_SMOOTHING."""
+    counts = transition_model['counts']
+    n = len(counts)
+    probabilities = transition_model['powers'][1].copy()
+    probabilities[counts.sum(axis=1) == 0] = 1.0 / n
+    return (1.0 - TIMELINE_SMOOTHING) * probabilities + TIMELINE_SMOOTHING / n
+
+def viterbi(log_start, log_transitions, log_emissions):
+    """Most likely state sequence of an HMM, all in log space; log_emissions is (steps, states)."""
+    n_steps, n_states = log_emissions.shape
+    backpointers = np.empty((n_steps, n_states), dtype=np.intp)
+    delta = log_start + log_emissions[0]
+    for t in range(1, n_steps):
+        scores = delta[:, np.newaxis] + log_transitions
+        backpointers[t] = scores.argmax(axis=0)
+        delta = scores[backpointers[t], np.arange(n_states)] + log_emissions[t]
+    path = np.empty(n_steps, dtype=np.intp)
+    path[-1] = delta.argmax()
+    for t in range(n_steps - 1, 0, -1):
+        path[t - 1] = backpointers[t, path[t]]
+    return path
+
+def forward_backward(start, transitions, emissions):
+    """Posterior P(state at step t | all steps) of an HMM, with per-step rescaling against underflow."""
+    n_steps = len(emissions)
+    alpha = np.empty(emissions.shape)
+    alpha[0] = start * emissions[0]
+    alpha[0] /= alpha[0].sum()
+    for t in range(1, n_steps):
+        alpha[t] = (alpha[t - 1] @ transitions) * emissions[t]
+        alpha[t] /= alpha[t].sum()
+    beta = np.ones(emissions.shape)
+    for t in range(n_steps - 2, -1, -1):
+        beta[t] = transitions @ (emissions[t + 1] * beta[t + 1])
+        beta[t] /= beta[t].sum()
+    posterior = alpha * beta
+    return posterior / posterior.sum(axis=1, keepdims=True)
 
-    return jsonify({"prediction": predicted_location, "reason": reason})
+def _parse_timeline(timeline):
+    """
+    Validates an ordered timeline. Steps with a 'location' object are observed; steps without one
+    are unknown and need a 'startTime'. Consecutive unknown steps form one multi-hop gap.
+    Returns a list of (step id, start time or None, observed location name or None); raises ValueError.
+    """
+    if not isinstance(timeline, list) or not timeline:
+        raise ValueError("Invalid request body: 'timeline' must be a non-empty list.")
+    if len(timeline) > MAX_TIMELINE_STEPS:
+        raise ValueError(f"Invalid 'timeline': at most {MAX_TIMELINE_STEPS} steps per request.")
+    steps = []
+    for i, step in enumerate(timeline):
+        try:
+            location = step.get('location')
+            if location is not None:
+                steps.append((step.get('id', i), None, location['name']))
+            else:
+                steps.append((step.get('id', i), datetime.fromisoformat(step['startTime'].replace('Z', '+00:00')), None))
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            raise ValueError(f"Invalid timeline step {i}: {e}")
+    return steps
+
+def _validate_history(all_locations, historical_activity):
+    """Checks the shape of 'allLocations' and row-wise 'historicalActivity'; raises ValueError."""
+    if not isinstance(all_locations, list):
+        raise ValueError("Invalid request body: 'allLocations' must be a list.")
+    for i, location in enumerate(all_locations):
+        if not isinstance(location, dict) or 'id' not in location:
+            raise ValueError(f"Invalid 'allLocations' entry {i}: expected an object with an 'id'.")
+    if is_columnar(historical_activity):
+        return
+    if not isinstance(historical_activity, list):
+        raise ValueError("Invalid request body: 'historicalActivity' must be a list or a column-wise table.")
+    for i, activity in enumerate(historical_activity):
+        if not isinstance(activity, dict):
+            raise ValueError(f"Invalid 'historicalActivity' entry {i}: expected an object.")
+
+def decode_timeline(current, all_locations, frequencies, steps):
+    """
+    Fills every unknown step of a timeline in one pass. Hidden states are the transition model's
+    locations, moves follow the learned transition matrix and each unknown step's emission is the
+    historical-pattern model's score for that location at that time; observed steps are pinned to
+    their location. Viterbi picks the jointly most likely path, so consecutive gaps agree with each
+    other, and forward-backward gives each chosen location's posterior as its confidence.
+    An observed location the transition model has never seen splits the timeline in two.
+    """
+    transition_model = current['transitions']
+    index, n_states = transition_model['index'], len(transition_model['locations'])
+    candidate_mask = np.zeros(n_states, dtype=bool)
+    for location in all_locations:
+        if location.get('name') in index:
+            candidate_mask[index[location['name']]] = True
+    locations_by_name = {}
+    for location in all_locations:
+        locations_by_name.setdefault(location.get('name'), location)
+
+    unknown = [t for t, (_, _, observed) in enumerate(steps) if observed is None]
+    if not unknown:
+        return []
+    if not candidate_mask.any():
+        return [{"id": steps[t][0], "prediction": None, "reason": "None of the candidate locations appear in the journey history."} for t in unknown]
+
+    # --- 1. Historical Model: every unknown step's candidate rows through the forest at once ---
+    probabilities = _historical_probabilities(current, np.concatenate([_live_features(steps[t][1], frequencies) for t in unknown]))
+    n_rows = len(frequencies)
+    class_states = np.array([index.get(name, -1) for name in current['class_names']], dtype=np.intp)
+    known_classes = class_states >= 0
+    historical = np.zeros((len(unknown), n_states))
+    historical[:, class_states[known_classes]] = probabilities.reshape(len(unknown), n_rows, -1).sum(axis=1)[:, known_classes]
+    historical *= candidate_mask
+
+    transitions = transition_probabilities(transition_model)
+    log_transitions = np.log(transitions)
+    start = np.full(n_states, 1.0 / n_states)
+    counts = transition_model['counts']
+    uniform_candidates = candidate_mask / candidate_mask.sum()
+    emissions = np.empty((len(steps), n_states))
+    row_of = {t: k for k, t in enumerate(unknown)}
+    for t, (_, _, observed) in enumerate(steps):
+        if observed is None:
+            scores = historical[row_of[t]]
+            total = scores.sum()
+            emissions[t] = (1.0 - TIMELINE_SMOOTHING) * scores / total + TIMELINE_SMOOTHING * uniform_candidates if total > 0 else uniform_candidates
+        elif observed in index:
+            emissions[t] = 0.0
+            emissions[t, index[observed]] = 1.0
+
+    # --- 2. Journey Model: decode each stretch between locations the model has never seen ---
+    with metrics.span('journey'):
+        path = np.full(len(steps), -1, dtype=np.intp)
+        posterior = np.zeros(len(steps))
+        segment_start = 0
+        for end in range(len(steps) + 1):
+            if end < len(steps) and (steps[end][2] is None or steps[end][2] in index):
+                continue
+            if any(steps[t][2] is None for t in range(segment_start, end)):
+                segment = emissions[segment_start:end]
+                with np.errstate(divide='ignore'):
+                    segment_path = viterbi(np.log(start), log_transitions, np.log(segment))
+                marginals = forward_backward(start, transitions, segment)
+                path[segment_start:end] = segment_path
+                posterior[segment_start:end] = marginals[np.arange(end - segment_start), segment_path]
+            segment_start = end + 1
+
+    # --- 3. Results, with each gap's observed neighbours for the explanation ---
+    results = []
+    for k, t in enumerate(unknown):
+        before = next((steps[s][2] for s in range(t - 1, -1, -1) if steps[s][2] is not None), None)
+        after = next((steps[s][2] for s in range(t + 1, len(steps)) if steps[s][2] is not None), None)
+        informed = (historical[k].sum() > 0 or (before in index and counts[index[before]].sum() > 0)
+                    or (after in index and counts[:, index[after]].sum() > 0))
+        if not informed:
+            results.append({"id": steps[t][0], "prediction": None, "reason": "Not enough historical data to predict a likely journey."})
+            continue
+        best_location_name = transition_model['locations'][path[t]]
+        confidence = posterior[t]
+        reason = (f"The most likely path from '{before or 'the start of the timeline'}' to '{after or 'the end of the timeline'}' "
+                  f"is via this location. Model confidence: {confidence*100:.0f}%.")
+        results.append({"id": steps[t][0], "prediction": locations_by_name.get(best_location_name), "confidence": float(confidence), "reason": reason})
+    return results
+
+def _observe_payload(endpoint, all_locations, historical_activity, n_gaps):
+    metrics.observe('locations', len(all_locations) if isinstance(all_locations, list) else 0, endpoint)
+    if is_columnar(historical_activity):
+        metrics.observe('history_events', len(column(historical_activity.get('locationId', []))), endpoint)
+    elif isinstance(historical_activity, list):
+        metrics.observe('history_events', len(historical_activity), endpoint)
+    metrics.observe('gaps', n_gaps, endpoint)
+
+@app.errorhandler(PayloadError)
+def payload_error(error):
+    return jsonify({"error": str(error)}), error.status
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Readiness probe: 200 once the location artifacts are loaded, 503 otherwise."""
+    current = current_artifacts()
+    ready = current is not None
+    return jsonify({
+        "status": "ready" if ready else "unavailable", "artifactsLoaded": ready,
+        "artifactVersion": current['directory'] if ready else None, "pid": os.getpid(),
+    }), 200 if ready else 503
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters and size of this process's prediction cache."""
+    return jsonify(result_cache.stats())
+
+@app.route('/predict/location', methods=['POST'])
+def predict():
+    current = current_artifacts()
+    if not current:
+        return jsonify({"error": "Model artifacts not loaded. Please train the model first."}), 500
+
+    with metrics.span('parse'):
+        data = read_request_body(request)
+    if not data or not all(k in data for k in ['startTime', 'historicalActivity', 'allLocations', 'locationBefore', 'locationAfter']):
+        return jsonify({"error": "Invalid request body: Missing required keys."}), 400
+    try:
+        start_time, loc_before, loc_after, hops = _parse_gap_query(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    _observe_payload('predict', data['allLocations'], data['historicalActivity'], 1)
+    frequencies = _historical_frequencies(data['historicalActivity'], data['allLocations'])
+    with metrics.span('cache_lookup'):
+        cache_key = _gap_cache_key(current, start_time, loc_before, loc_after, hops, frequencies, data['allLocations'])
+        cached = result_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        return app.response_class(cached, mimetype='application/json')
+
+    probabilities = _historical_probabilities(current, _live_features(start_time, frequencies))
+    prediction = _predict_gap(current, data['allLocations'], probabilities, loc_before, loc_after, hops)
+    with metrics.span('serialize'):
+        response = jsonify(prediction)
+    if cache_key:
+        result_cache.put(cache_key, response.get_data())
+    return response
+
+@app.route('/predict/location/batch', methods=['POST'])
+def predict_batch():
+    """
+    Fills many timeline gaps against one shared location list. Each query may carry its own
+    'historicalActivity' or fall back to the shared one; history frequencies are computed once
+    per distinct history and all queries go through the forest in a single pass. A malformed
+    query gets an 'error' entry instead of failing the batch.
+    """
+    current = current_artifacts()
+    if not current:
+        return jsonify({"error": "Model artifacts not loaded. Please train the model first."}), 500
+
+    with metrics.span('parse'):
+        data = read_request_body(request)
+    if not data or 'allLocations' not in data or not isinstance(data.get('queries'), list):
+        return jsonify({"error": "Invalid request body: 'allLocations' and a 'queries' list are required."}), 400
+
+    all_locations = data['allLocations']
+    _observe_payload('predict_batch', all_locations, data.get('historicalActivity'), len(data['queries']))
+    shared_frequencies = None
+    results, rows, answered = [], [], []
+    for i, query in enumerate(data['queries']):
+        query_id = query.get('id', i) if isinstance(query, dict) else i
+        try:
+            if not isinstance(query, dict):
+                raise ValueError("Invalid gap query: expected an object.")
+            start_time, loc_before, loc_after, hops = _parse_gap_query(query)
+            if 'historicalActivity' in query:
+                frequencies = _historical_frequencies(query['historicalActivity'], all_locations)
+            elif 'historicalActivity' in data:
+                if shared_frequencies is None:
+                    shared_frequencies = _historical_frequencies(data['historicalActivity'], all_locations)
+                frequencies = shared_frequencies
+            else:
+                raise ValueError("Missing 'historicalActivity' for this query and the batch.")
+        except (ValueError, TypeError, AttributeError) as e:
+            results.append({"id": query_id, "error": str(e)})
+            continue
+        rows.append(_live_features(start_time, frequencies))
+        answered.append((i, loc_before, loc_after, hops))
+        results.append({"id": query_id})
+
+    if answered:
+        probabilities = _historical_probabilities(current, np.concatenate(rows))
+        n_locations = len(all_locations)
+        for k, (i, loc_before, loc_after, hops) in enumerate(answered):
+            results[i].update(_predict_gap(current, all_locations, probabilities[k * n_locations:(k + 1) * n_locations], loc_before, loc_after, hops))
+
+    with metrics.span('serialize'):
+        return jsonify({"results": results})
+
+@app.route('/predict/location/timeline', methods=['POST'])
+def predict_timeline():
+    """
+    Fills every gap in a user's ordered timeline with one HMM decode instead of one
+    /predict/location call per gap; see decode_timeline. 'historicalActivity' is sent once
+    for the whole timeline.
+    """
+    current = current_artifacts()
+    if not current:
+        return jsonify({"error": "Model artifacts not loaded. Please train the model first."}), 500
+
+    with metrics.span('parse'):
+        data = read_request_body(request)
+    if not data or not all(k in data for k in ['timeline', 'historicalActivity', 'allLocations']):
+        return jsonify({"error": "Invalid request body: 'timeline', 'historicalActivity' and 'allLocations' are required."}), 400
+    try:
+        steps = _parse_timeline(data['timeline'])
+        _validate_history(data['allLocations'], data['historicalActivity'])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    _observe_payload('predict_timeline', data['allLocations'], data['historicalActivity'], sum(observed is None for _, _, observed in steps))
+    frequencies = _historical_frequencies(data['historicalActivity'], data['allLocations'])
+    results = decode_timeline(current, data['allLocations'], frequencies, steps)
+    with metrics.span('serialize'):
+        return jsonify({"results": results})
 
 def run_api():
-    if not model:
+    if not artifacts:
         print("\nCannot start API. Please run 'python location_prediction_service.py train' first.")
         return
     print(f"\n* Starting Location Prediction server on http://12-7.0.0.1:{API_PORT}")
     app.run(port=API_PORT, debug=False)
 
+def serve_api(host, port, workers=None):
+    if not artifacts:
+        print("\nCannot start API. Please run 'python location_prediction_service.py train' first.")
+        return
+    from serving import serve
+    serve(app, host, port, workers=workers)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Location Prediction Service")
-    parser.add_argument('mode', choices=['train', 'run'])
+    parser.add_argument('mode', choices=['train', 'update', 'export', 'run', 'serve'], help="Mode: 'train' to build all artifacts, 'update' to fold new swipes into the current ones, 'export' to add serving bundles to the current ones, 'run'/'serve' to start the API.")
+    parser.add_argument('--swipes', default=os.path.join(DATA_DIR, 'campus_card_swipes.csv'), help="CSV of new swipes for 'update' mode (same columns as campus_card_swipes.csv).")
+    parser.add_argument('--workers', type=int, default=None, help="Cores used to train the forest, or worker processes in 'serve' mode (default: all cores).")
+    parser.add_argument('--sample-per-location', type=int, default=TRAINING_SAMPLE_PER_LOCATION, help=f"Train the forest on a stratified, prior-weighted sample of at most this many swipes per location; 0 trains on every swipe, with memory growing with the history (default: {TRAINING_SAMPLE_PER_LOCATION}).")
+    parser.add_argument('--host', default='127.0.0.1', help="Interface to listen on in 'serve' mode.")
+    parser.add_argument('--port', type=int, default=API_PORT, help=f"Port to listen on in 'serve' mode (default: {API_PORT}).")
     args = parser.parse_args()
     if args.mode == 'train':
-        train_model()
+        train_model(workers=args.workers, sample_per_location=args.sample_per_location)
+    elif args.mode == 'update':
+        update_model(args.swipes)
+    elif args.mode == 'export':
+        export_artifacts()
+    elif args.mode == 'serve':
+        serve_api(args.host, args.port, workers=args.workers)
     else:
         run_api()
@@ -1,16 +1,20 @@
 import os
 import warnings
 import argparse
-import joblib
 import numpy as np
-import pandas as pd
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LogisticRegression
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import accuracy_score, classification_report
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from datetime import datetime
+from artifact_format import ArtifactError, open_bundle, read_manifest, write_bundle, write_manifest
+from evidence_store import EvidenceStore
+from metrics import COUNT_BUCKETS, Metrics
+from result_cache import ResultCache, array_digest, artifact_version, canonical_digest
+from wire_format import MISSING_TIMESTAMP, PayloadError, check_table, column, is_columnar, read_request_body
+from datetime import datetime, timedelta, timezone
+from bisect import bisect_left
+from collections import defaultdict
+import hashlib
+import hmac
+import json
 import random
 
 # --- Configuration ---
@@ -20,16 +24,97 @@ DATA_DIR = "datasets"
 MODEL_PATH = os.path.join(MODEL_DIR, "owner_prediction_model.pkl")
 SCALER_PATH = os.path.join(MODEL_DIR, "owner_feature_scaler.pkl")
 TRAINING_DATA_PATH = os.path.join(MODEL_DIR, "training_features.csv")
+TRAINING_DATA_META_PATH = os.path.join(MODEL_DIR, "training_features.meta.json")
+EVIDENCE_STORE_DIR = os.path.join(MODEL_DIR, "evidence_store")
+SERVING_ARTIFACT_PATH = os.path.join(MODEL_DIR, "owner_model.npz") # Scaler and coefficients for 'run'/'serve' (see artifact_format)
+SERVING_MANIFEST_PATH = os.path.join(MODEL_DIR, "owner_manifest.json")
+SERVING_ARRAYS = ('scaler_mean', 'scaler_scale', 'coef', 'intercept')
 API_PORT = 5001
 FEATURE_COLUMNS = ['time_diff_wifi', 'same_location_wifi', 'is_in_booking', 'has_alibi', 'time_diff_cctv_face', 'face_match_in_frame']
+FEATURE_VERSION = 2 # Bump whenever create_features_from_raw_data changes what it computes; invalidates cached training data.
+TRAINING_CSVS = {
+    'users': 'student_or_staff_profiles.csv', 'swipes': 'campus_card_swipes.csv', 'wifi': 'wifi_associations_logs.csv',
+    'cctv': 'cctv_frames.csv', 'lab': 'lab_bookings.csv', 'library': 'library_checkouts.csv',
+}
+TRAINING_SEED = 42
+NEGATIVE_SAMPLES_PER_SWIPE = 4
+TRAINING_CHUNK_SIZE = 500 # Fixed so the sampled negatives don't depend on the worker count.
+RESULT_CACHE_MAX_BYTES = 64 * 2**20
+RESULT_CACHE_TTL_SECONDS = 300
+INGEST_TOKEN_ENV = "EVIDENCE_INGEST_TOKEN" # POST /evidence/ingest needs 'Authorization: Bearer <token>'; unset disables it
 
 # --- Phase 1: Feature Engineering ---
 
-def create_features_from_raw_data(anchor_events, candidate_user, all_evidence):
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_EPOCH_AWARE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_MICROSECOND = timedelta(microseconds=1)
+
+def _parse_timestamp(value):
+    """
+    Parses an ISO timestamp into (is_aware, epoch_microseconds), or None if it can't be parsed.
+    Naive and aware timestamps can't be compared with each other, so callers keep them apart.
+    """
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (ValueError, TypeError, AttributeError):
+        return None
+    is_aware = parsed.utcoffset() is not None
+    return is_aware, (parsed - (_EPOCH_AWARE if is_aware else _EPOCH_NAIVE)) // _ONE_MICROSECOND
+
+def _nearest_gap(sorted_times, target):
+    """Returns the smallest |t - target| over a sorted list of epoch microseconds, or None if empty."""
+    i = bisect_left(sorted_times, target)
+    best = None
+    if i < len(sorted_times):
+        best = sorted_times[i] - target
+    if i > 0 and (best is None or target - sorted_times[i - 1] < best):
+        best = target - sorted_times[i - 1]
+    return best
+
+def build_evidence_index(all_evidence):
+    """
+    Indexes an 'allEvidence' payload once so that feature lookups for each
+    candidate are dictionary hits and bisects instead of full scans.
+    """
+    wifi = defaultdict(lambda: {False: [], True: []})  # (userId, accessPointId) -> sorted times
+    for log in all_evidence.get('wifiLogs', []):
+        key = ((log.get('device') or {}).get('userId'), log.get('accessPointId'))
+        times = wifi[key]
+        parsed = _parse_timestamp(log.get('timestamp'))
+        if parsed:
+            times[parsed[0]].append(parsed[1])
+
+    bookings = set()  # (userId, locationId)
+    for booking in all_evidence.get('bookings', []):
+        bookings.add((booking.get('userId'), booking.get('locationId')))
+
+    alibi_users = {(alibi.get('card') or {}).get('userId') for alibi in all_evidence.get('alibiSwipes', [])}
+
+    cctv = defaultdict(lambda: {'times': {False: [], True: []}, 'faces': {False: set(), True: set()}})  # locationId -> frames
+    for frame in all_evidence.get('cctvFrames', []):
+        parsed = _parse_timestamp(frame.get('timestamp'))
+        if not parsed:
+            continue
+        entry = cctv[frame.get('locationId')]
+        entry['times'][parsed[0]].append(parsed[1])
+        entry['faces'][parsed[0]].update(frame.get('detectedFaceIds') or [])
+
+    for times in wifi.values():
+        times[False].sort(); times[True].sort()
+    for entry in cctv.values():
+        entry['times'][False].sort(); entry['times'][True].sort()
+
+    return {"wifi": dict(wifi), "bookings": bookings, "alibi_users": alibi_users, "cctv": dict(cctv)}
+
+def create_features_from_raw_data(anchor_events, candidate_user, all_evidence, evidence_index=None):
     """
     Calculates a numerical feature vector for a single (anchor_event, candidate_user) pair.
     This is the core logic, used for both training and live prediction.
+    Pass a prebuilt `evidence_index` when scoring many candidates against the same evidence.
     """
+    if evidence_index is None:
+        evidence_index = build_evidence_index(all_evidence)
+
     best_time_diff_wifi = 999
     same_location_wifi = 0
     is_in_booking = 0
@@ -37,135 +122,536 @@ def create_features_from_raw_data(anchor_events, candidate_user, all_evidence):
     best_time_diff_cctv = 999
     face_match_in_frame = 0
 
-    candidate_face_id = all_evidence.get('user_to_face_map', {}).get(candidate_user['id'])
+    candidate_id = candidate_user['id']
+    candidate_face_id = all_evidence.get('user_to_face_map', {}).get(candidate_id)
 
     for event in anchor_events:
-        try:
-            event_time = datetime.fromisoformat(event['timestamp'].replace('Z', '+00:00'))
-            event_location_id = event.get('locationId')
-            if not event_location_id: continue
-        except (ValueError, TypeError): continue
-
-        for log in all_evidence.get('wifiLogs', []):
-            if log.get('device', {}).get('userId') == candidate_user['id'] and log.get('accessPointId') == event_location_id:
-                same_location_wifi = 1
-                try:
-                    log_time = datetime.fromisoformat(log['timestamp'].replace('Z', '+00:00'))
-                    time_diff = abs((event_time - log_time).total_seconds())
-                    if time_diff < best_time_diff_wifi: best_time_diff_wifi = time_diff
-                except (ValueError, TypeError): continue
-        
-        for booking in all_evidence.get('bookings', []):
-            if booking.get('userId') == candidate_user['id'] and booking.get('locationId') == event_location_id:
-                is_in_booking = 1
-                
-        for alibi in all_evidence.get('alibiSwipes', []):
-            if alibi.get('card', {}).get('userId') == candidate_user['id']:
-                has_alibi = 1
-        
-        for frame in all_evidence.get('cctvFrames', []):
-            if frame.get('locationId') == event_location_id:
-                try:
-                    frame_time = datetime.fromisoformat(frame['timestamp'].replace('Z', '+00:00'))
-                    time_diff = abs((event_time - frame_time).total_seconds())
-                    if time_diff < best_time_diff_cctv:
-                        best_time_diff_cctv = time_diff
-                    if candidate_face_id and candidate_face_id in frame.get('detectedFaceIds', []):
-                        face_match_in_frame = 1
-                except (ValueError, TypeError): continue
-    
+        event_time = _parse_timestamp(event.get('timestamp'))
+        event_location_id = event.get('locationId')
+        if not event_location_id or not event_time: continue
+        is_aware, event_us = event_time
+
+        wifi_times = evidence_index['wifi'].get((candidate_id, event_location_id))
+        if wifi_times is not None:
+            same_location_wifi = 1
+            gap = _nearest_gap(wifi_times[is_aware], event_us)
+            if gap is not None and gap / 10**6 < best_time_diff_wifi: best_time_diff_wifi = gap / 10**6
+
+        if (candidate_id, event_location_id) in evidence_index['bookings']:
+            is_in_booking = 1
+
+        if candidate_id in evidence_index['alibi_users']:
+            has_alibi = 1
+
+        frames = evidence_index['cctv'].get(event_location_id)
+        if frames is not None:
+            gap = _nearest_gap(frames['times'][is_aware], event_us)
+            if gap is not None and gap / 10**6 < best_time_diff_cctv: best_time_diff_cctv = gap / 10**6
+            if candidate_face_id and candidate_face_id in frames['faces'][is_aware]:
+                face_match_in_frame = 1
+
     return {
         "time_diff_wifi": best_time_diff_wifi, "same_location_wifi": same_location_wifi,
         "is_in_booking": is_in_booking, "has_alibi": has_alibi,
         "time_diff_cctv_face": best_time_diff_cctv, "face_match_in_frame": face_match_in_frame
     }
 
-def generate_training_data_from_csvs():
+# --- Phase 1b: Columnar Feature Engine (batch scoring) ---
+_NO_GAP = np.iinfo(np.int64).max
+_MAX_PAIRS_PER_BLOCK = 4_000_000
+
+EVIDENCE_TABLES = ('wifiLogs', 'bookings', 'alibiSwipes', 'cctvFrames')
+
+def columnize_anchor_events(anchor_events):
+    """Parses anchor events into NumPy columns, dropping events without a location or a usable timestamp."""
+    if is_columnar(anchor_events):
+        return _columnar_anchor_events(anchor_events)
+    anchors = [(event.get('locationId'), _parse_timestamp(event.get('timestamp'))) for event in anchor_events]
+    anchors = [(loc, parsed) for loc, parsed in anchors if loc and parsed]
+    return {
+        "anchor_location": _object_column(loc for loc, _ in anchors),
+        "anchor_aware": np.array([parsed[0] for _, parsed in anchors], dtype=bool),
+        "anchor_time": np.array([parsed[1] for _, parsed in anchors], dtype=np.int64),
+    }
+
+def columnize_evidence(all_evidence):
     """
-    Reads all raw CSV data and synthesizes a labeled training dataset
-    by calling the SAME feature engineering function used in production.
+    Parses an 'allEvidence' payload once into flat NumPy columns.
+    Timestamps become epoch microseconds plus an 'aware' flag, ids stay as object
+    arrays and are integer-coded against the candidates in build_feature_tensor.
+    Tables may also arrive column-wise (see wire_format), which skips per-row parsing entirely.
     """
-    print("Generating training data from raw CSV files...")
-    if os.path.exists(TRAINING_DATA_PATH):
-        print(f"'{TRAINING_DATA_PATH}' already exists. Loading from file.")
-        return pd.read_csv(TRAINING_DATA_PATH)
+    if any(is_columnar(all_evidence.get(table)) for table in EVIDENCE_TABLES):
+        return _columnar_evidence(all_evidence)
+    wifi_logs = all_evidence.get('wifiLogs', [])
+    wifi_times = [_parse_timestamp(log.get('timestamp')) for log in wifi_logs]
 
-    try:
-        # Load all necessary raw data sources
-        users_df = pd.read_csv(os.path.join(DATA_DIR, 'student_or_staff_profiles.csv'))
-        swipes_df = pd.read_csv(os.path.join(DATA_DIR, 'campus_card_swipes.csv'))
-        wifi_df = pd.read_csv(os.path.join(DATA_DIR, 'wifi_associations_logs.csv'))
-        cctv_df = pd.read_csv(os.path.join(DATA_DIR, 'cctv_frames.csv'))
-        notes_df = pd.read_csv(os.path.join(DATA_DIR, 'free_text_notes (helpdesk or RSVps).csv'))
-        lab_df = pd.read_csv(os.path.join(DATA_DIR, 'lab_bookings.csv'))
-        library_df = pd.read_csv(os.path.join(DATA_DIR, 'library_checkouts.csv'))
-    except FileNotFoundError as e:
-        print(f"Error: Required CSV not found - {e}. Aborting training.")
+    cctv_frames, cctv_times = [], []
+    for frame in all_evidence.get('cctvFrames', []):
+        parsed = _parse_timestamp(frame.get('timestamp'))
+        if parsed:
+            cctv_frames.append(frame)
+            cctv_times.append(parsed)
+    face_frame, face_id = [], []
+    for i, frame in enumerate(cctv_frames):
+        for detected in frame.get('detectedFaceIds') or []:
+            face_frame.append(i)
+            face_id.append(detected)
+
+    face_map = all_evidence.get('user_to_face_map', {})
+    bookings = all_evidence.get('bookings', [])
+    alibis = all_evidence.get('alibiSwipes', [])
+
+    return {
+        "wifi_user": _object_column((log.get('device') or {}).get('userId') for log in wifi_logs),
+        "wifi_location": _object_column(log.get('accessPointId') for log in wifi_logs),
+        "wifi_has_time": np.array([parsed is not None for parsed in wifi_times], dtype=bool),
+        "wifi_aware": np.array([bool(parsed and parsed[0]) for parsed in wifi_times], dtype=bool),
+        "wifi_time": np.array([parsed[1] if parsed else 0 for parsed in wifi_times], dtype=np.int64),
+        "booking_user": _object_column(booking.get('userId') for booking in bookings),
+        "booking_location": _object_column(booking.get('locationId') for booking in bookings),
+        "alibi_user": _object_column((alibi.get('card') or {}).get('userId') for alibi in alibis),
+        "cctv_location": _object_column(frame.get('locationId') for frame in cctv_frames),
+        "cctv_aware": np.array([parsed[0] for parsed in cctv_times], dtype=bool),
+        "cctv_time": np.array([parsed[1] for parsed in cctv_times], dtype=np.int64),
+        "face_frame": np.array(face_frame, dtype=np.intp),
+        "face_id": _object_column(face_id),
+        "face_user": _object_column(face_map.keys()),
+        "face_of_user": _object_column(face_map.values()),
+    }
+
+def columnize_payload(anchor_events, all_evidence):
+    """Parses an (anchorEvents, allEvidence) payload once into the columns build_feature_matrix uses."""
+    return {**columnize_anchor_events(anchor_events), **columnize_evidence(all_evidence)}
+
+def _columnar_anchor_events(anchor_events):
+    """Column-wise anchor events: {'locationId': [...], 'timestamp': [epoch microseconds]}."""
+    locations = column(anchor_events.get('locationId', []))
+    times = column(anchor_events.get('timestamp', []), np.int64)
+    check_table('anchorEvents', locationId=locations, timestamp=times)
+    usable = (times != MISSING_TIMESTAMP) & _truthy(locations)
+    return {
+        "anchor_location": locations[usable],
+        "anchor_aware": np.ones(int(usable.sum()), dtype=bool),
+        "anchor_time": times[usable],
+    }
+
+def _columnar_evidence(all_evidence):
+    """
+    Column-wise evidence tables (see wire_format). Wi-Fi logs and CCTV frames carry
+    'timestamp' columns of epoch microseconds, CCTV faces are CSR-style
+    {'offsets': [...], 'values': [...]} and the face map is {'userId': [...], 'faceId': [...]}.
+    A payload is either all rows or all columns: mixing them raises PayloadError rather
+    than losing the row tables.
+    """
+    def table(name):
+        value = all_evidence.get(name)
+        if is_columnar(value):
+            return value
+        if value:
+            raise PayloadError(f"Invalid request body: '{name}' is sent as rows, but other evidence tables are column-wise; send every table the same way.")
+        return {}
+
+    wifi, bookings, alibis, cctv, faces = (table(name) for name in EVIDENCE_TABLES + ('user_to_face_map',))
+    if set(faces) - {'userId', 'faceId'}:
+        raise PayloadError("Invalid request body: a column-wise 'user_to_face_map' must be {'userId': [...], 'faceId': [...]}.")
+
+    wifi_user, wifi_location = column(wifi.get('userId', [])), column(wifi.get('accessPointId', []))
+    wifi_time = column(wifi.get('timestamp', []), np.int64)
+    check_table('wifiLogs', userId=wifi_user, accessPointId=wifi_location, timestamp=wifi_time)
+    booking_user, booking_location = column(bookings.get('userId', [])), column(bookings.get('locationId', []))
+    check_table('bookings', userId=booking_user, locationId=booking_location)
+    face_user, face_of_user = column(faces.get('userId', [])), column(faces.get('faceId', []))
+    check_table('user_to_face_map', userId=face_user, faceId=face_of_user)
+    cctv_location = column(cctv.get('locationId', []))
+    cctv_time = column(cctv.get('timestamp', []), np.int64)
+    check_table('cctvFrames', locationId=cctv_location, timestamp=cctv_time)
+    cctv_timed = cctv_time != MISSING_TIMESTAMP
+
+    detected = cctv.get('detectedFaceIds') or {}
+    offsets = column(detected.get('offsets', [0] * (len(cctv_time) + 1)), np.intp)
+    face_id = column(detected.get('values', []))
+    if len(offsets) != len(cctv_time) + 1 or offsets[0] != 0 or offsets[-1] != len(face_id) or np.any(np.diff(offsets) < 0):
+        raise PayloadError("Invalid request body: 'cctvFrames.detectedFaceIds' offsets must rise from 0 to the number of values, one per frame plus one.")
+    face_frame = np.repeat(np.arange(len(cctv_time)), np.diff(offsets))
+    kept_faces = cctv_timed[face_frame]
+    # Frames without a timestamp are dropped, so renumber the surviving frames' detections.
+    frame_number = np.cumsum(cctv_timed) - 1
+
+    return {
+        "wifi_user": wifi_user,
+        "wifi_location": wifi_location,
+        "wifi_has_time": wifi_time != MISSING_TIMESTAMP,
+        "wifi_aware": np.ones(len(wifi_time), dtype=bool),
+        "wifi_time": wifi_time,
+        "booking_user": booking_user,
+        "booking_location": booking_location,
+        "alibi_user": column(alibis.get('userId', [])),
+        "cctv_location": cctv_location[cctv_timed],
+        "cctv_aware": np.ones(int(cctv_timed.sum()), dtype=bool),
+        "cctv_time": cctv_time[cctv_timed],
+        "face_frame": frame_number[face_frame[kept_faces]].astype(np.intp),
+        "face_id": face_id[kept_faces],
+        "face_user": face_user,
+        "face_of_user": face_of_user,
+    }
+
+def _truthy(values):
+    if values.dtype != object:
+        return values != 0
+    return np.fromiter((bool(value) for value in values), dtype=bool, count=len(values))
+
+def _object_column(values):
+    values = list(values)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+def _encode(values, codes):
+    """Maps each value to its integer code, or -1 if it has none."""
+    if values.dtype.kind in 'iu' and codes and all(isinstance(key, (int, np.integer)) and not isinstance(key, bool) for key in codes):
+        # Integer ids (e.g. typed-buffer columns): vectorized lookup against the sorted keys.
+        keys = np.fromiter(codes.keys(), dtype=np.int64, count=len(codes))
+        code_values = np.fromiter(codes.values(), dtype=np.intp, count=len(codes))
+        order = np.argsort(keys)
+        keys, code_values = keys[order], code_values[order]
+        position = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+        return np.where(keys[position] == values, code_values[position], -1)
+    return np.fromiter((codes.get(value, -1) for value in values), dtype=np.intp, count=len(values))
+
+def _min_gap_per_query(row_location, row_aware, row_time, anchors):
+    """
+    For every (query, evidence row), the smallest |row_time - anchor_time| over that query's
+    anchors with the same location code and timezone awareness, broadcasting anchors x rows
+    in bounded blocks. Pairs with no such anchor (including location code -1) get _NO_GAP.
+    """
+    gaps = np.full((anchors['n_queries'], len(row_location)), _NO_GAP, dtype=np.int64)
+    rows = np.flatnonzero(row_location >= 0)
+    n_anchors = len(anchors['time'])
+    if len(rows) == 0 or n_anchors == 0:
+        return gaps
+    block = max(1, _MAX_PAIRS_PER_BLOCK // n_anchors)
+    for start in range(0, len(rows), block):
+        chunk = rows[start:start + block]
+        match = (row_location[chunk][None, :] == anchors['location'][:, None]) & (row_aware[chunk][None, :] == anchors['aware'][:, None])
+        diff = np.where(match, np.abs(row_time[chunk][None, :] - anchors['time'][:, None]), _NO_GAP)
+        # Anchors are grouped by query, so each query's minimum is one segment reduction.
+        gaps[anchors['queries'][:, None], chunk] = np.minimum.reduceat(diff, anchors['starts'], axis=0)
+    return gaps
+
+def _gap_seconds(gap_us):
+    """Turns microsecond gaps into the capped seconds the model was trained on (999 = no evidence)."""
+    seconds = np.where(gap_us == _NO_GAP, np.inf, gap_us / 10**6)
+    return np.where(seconds < 999, seconds, 999.0)
+
+def build_pruned_features(evidence_columns, anchor_columns, candidate_ids):
+    """
+    Two-stage version of build_feature_tensor. Almost every candidate has no Wi-Fi, booking,
+    alibi or face evidence at the anchor locations and so gets the same evidence-free feature
+    row (only the CCTV gap, which is shared by all candidates, differs per query). The evidence
+    columns are first used as inverted indexes to find the candidates with any such hit, and
+    only those are featurized.
+    Returns (hits, features, defaults): the indexes into candidate_ids of the candidates with a
+    hit, their features as a (len(anchor_columns), len(hits), len(FEATURE_COLUMNS)) array, and the
+    (len(anchor_columns), len(FEATURE_COLUMNS)) feature row shared by every other candidate.
+    """
+    n_queries = len(anchor_columns)
+    user_codes = {}
+    candidate_codes = np.fromiter((user_codes.setdefault(uid, len(user_codes)) for uid in candidate_ids), dtype=np.intp, count=len(candidate_ids))
+
+    location_codes = {}
+    for columns in anchor_columns:
+        for loc in columns['anchor_location']:
+            location_codes.setdefault(loc, len(location_codes))
+    counts = np.array([len(columns['anchor_time']) for columns in anchor_columns], dtype=np.intp)
+    anchors = {
+        "n_queries": n_queries,
+        "location": _encode(np.concatenate([columns['anchor_location'] for columns in anchor_columns]), location_codes),
+        "aware": np.concatenate([columns['anchor_aware'] for columns in anchor_columns]),
+        "time": np.concatenate([columns['anchor_time'] for columns in anchor_columns]),
+        "queries": np.flatnonzero(counts), # queries with at least one usable anchor
+        "starts": (np.cumsum(counts) - counts)[counts > 0],
+    }
+    query_of_anchor = np.repeat(np.arange(n_queries), counts)
+    query_has_location = np.zeros((n_queries, len(location_codes) + 1), dtype=bool) # last column: code -1
+    query_has_location[query_of_anchor, anchors['location']] = True
+    query_has_location[:, -1] = False
+
+    wifi_user = _encode(evidence_columns['wifi_user'], user_codes)
+    wifi_location = _encode(evidence_columns['wifi_location'], location_codes)
+    booking_user = _encode(evidence_columns['booking_user'], user_codes)
+    booking_location = _encode(evidence_columns['booking_location'], location_codes)
+    alibi_user = _encode(evidence_columns['alibi_user'], user_codes)
+    cctv_location = _encode(evidence_columns['cctv_location'], location_codes)
+    face_codes = {}
+    face_user = _encode(evidence_columns['face_user'], user_codes)
+    face_owners = [(code, face_codes.setdefault(face, len(face_codes)))
+                   for code, face in zip(face_user, evidence_columns['face_of_user']) if code >= 0 and face]
+    owner_users, owner_faces = (np.array(column, dtype=np.intp) for column in zip(*face_owners)) if face_owners else (np.empty(0, dtype=np.intp),) * 2
+    face_frame = np.asarray(evidence_columns['face_frame'], dtype=np.intp)
+    frame_face = _encode(evidence_columns['face_id'], face_codes)
+
+    # Stage 1: a superset of the candidates whose features can differ from the default row,
+    # i.e. users with Wi-Fi or bookings at some anchor location, any alibi, or a face in a
+    # frame at some anchor location. Their user codes are compacted to 0..n_users-1.
+    visible_faces = frame_face[(frame_face >= 0) & (cctv_location[face_frame] >= 0)]
+    hit_codes = np.unique(np.concatenate([
+        wifi_user[wifi_location >= 0], booking_user[booking_location >= 0],
+        alibi_user if len(anchors['queries']) else alibi_user[:0], owner_users[np.isin(owner_faces, visible_faces)],
+    ]))
+    hit_codes = hit_codes[hit_codes >= 0]
+    n_users = len(hit_codes)
+    compact = np.full(len(user_codes) + 1, -1, dtype=np.intp) # last slot: code -1 stays -1
+    compact[hit_codes] = np.arange(n_users)
+    wifi_user, booking_user, alibi_user, owner_users = (compact[codes] for codes in (wifi_user, booking_user, alibi_user, owner_users))
+    owned = owner_users >= 0
+    owner_users, owner_faces = owner_users[owned], owner_faces[owned]
+
+    # Stage 2: exact features for the candidates with a hit.
+    def scatter_flags(row_user, row_location):
+        """(queries, users) flags for rows whose location is one of the query's anchor locations."""
+        flags = np.zeros((n_queries, n_users))
+        known = row_user >= 0
+        hits = query_has_location[:, row_location[known]]
+        query_index, row_index = np.nonzero(hits)
+        flags[query_index, row_user[known][row_index]] = 1
+        return flags
+
+    # Wi-Fi: any log at an anchor location counts, the time gap only within matching awareness.
+    same_location_wifi = scatter_flags(wifi_user, wifi_location)
+    wifi_rows = np.flatnonzero(wifi_user >= 0)
+    wifi_gaps = _min_gap_per_query(np.where(evidence_columns['wifi_has_time'][wifi_rows], wifi_location[wifi_rows], -1),
+                                   evidence_columns['wifi_aware'][wifi_rows], evidence_columns['wifi_time'][wifi_rows], anchors)
+    best_wifi = np.full(n_queries * n_users, _NO_GAP, dtype=np.int64)
+    flat_index = (np.arange(n_queries)[:, None] * n_users + wifi_user[wifi_rows][None, :]).ravel()
+    np.minimum.at(best_wifi, flat_index, wifi_gaps.ravel())
+    best_wifi = best_wifi.reshape(n_queries, n_users)
+
+    is_in_booking = scatter_flags(booking_user, booking_location)
+
+    # An alibi only counts when the query had at least one usable anchor event.
+    has_alibi = np.zeros((n_queries, n_users))
+    has_alibi[np.ix_(anchors['queries'], alibi_user[alibi_user >= 0])] = 1
+
+    # CCTV: the nearest frame is the same for every candidate; a face only counts in a frame
+    # that was comparable with some anchor event of the query.
+    cctv_gaps = _min_gap_per_query(cctv_location, evidence_columns['cctv_aware'], evidence_columns['cctv_time'], anchors)
+    best_cctv = _gap_seconds(cctv_gaps.min(axis=1, initial=_NO_GAP))
+    seen_face = np.zeros((n_queries, len(face_codes) + 1), dtype=bool) # last column: code -1
+    query_index, detection_index = np.nonzero(cctv_gaps[:, face_frame] != _NO_GAP)
+    seen_face[query_index, frame_face[detection_index]] = True
+    seen_face[:, -1] = False
+    face_match_in_frame = np.zeros((n_queries, n_users))
+    face_match_in_frame[:, owner_users] = seen_face[:, owner_faces]
+
+    features = np.stack([
+        _gap_seconds(best_wifi), same_location_wifi, is_in_booking,
+        has_alibi, np.repeat(best_cctv[:, None], n_users, axis=1), face_match_in_frame,
+    ], axis=-1)
+    defaults = np.zeros((n_queries, len(FEATURE_COLUMNS)))
+    defaults[:, FEATURE_COLUMNS.index('time_diff_wifi')] = 999.0
+    defaults[:, FEATURE_COLUMNS.index('time_diff_cctv_face')] = best_cctv
+    candidate_codes = compact[candidate_codes]
+    hits = np.flatnonzero(candidate_codes >= 0)
+    return hits, features[:, candidate_codes[hits]], defaults
+
+def build_feature_tensor(evidence_columns, anchor_columns, candidate_ids):
+    """
+    Computes all FEATURE_COLUMNS for every (query, candidate) pair in one pass, where each
+    query is one set of anchor columns scored against the same shared evidence. Returns a
+    float array of shape (len(anchor_columns), len(candidate_ids), len(FEATURE_COLUMNS)) whose
+    rows equal create_features_from_raw_data for the same anchors and candidate.
+    """
+    hits, features, defaults = build_pruned_features(evidence_columns, anchor_columns, candidate_ids)
+    tensor = np.repeat(defaults[:, None, :], len(candidate_ids), axis=1)
+    tensor[:, hits] = features
+    return tensor
+
+def build_feature_matrix(columns, candidate_ids):
+    """
+    Computes all FEATURE_COLUMNS for every candidate of a single columnized payload.
+    Returns a float array of shape (len(candidate_ids), len(FEATURE_COLUMNS)).
+    """
+    return build_feature_tensor(columns, [columns], candidate_ids)[0]
+
+# --- Phase 1c: Server-side Evidence Store ---
+
+def columnize_from_store(store, card_id, window_minutes):
+    """
+    Gathers the evidence the Next.js bridge would send for an unowned card, straight from the
+    evidence store, as feature-engine columns. Anchors are the card's swipes; Wi-Fi, CCTV and
+    alibi rows (other-location swipes and library checkouts) come from +/- window_minutes around
+    them, bookings from those covering an anchor. Candidates are every profile, coded by the store.
+    Returns (columns, candidates), or None if the card has no usable swipes.
+    """
+    card = store.code(card_id)
+    if not card:
+        return None
+    anchors = store.swipes_for_card(card)
+    located = anchors['location'] > 0
+    locations, times = anchors['location'][located], anchors['time'][located]
+    if not len(times):
         return None
 
-    # Convert dataframes to the list of dictionaries format our API expects
-    all_users = users_df.rename(columns={'entity_id': 'id', 'full_name': 'fullName', 'student_id': 'externalId'}).to_dict('records')
-    all_swipes = swipes_df.to_dict('records')
-    all_wifi = wifi_df.to_dict('records')
-    all_cctv = cctv_df.to_dict('records')
-    all_notes = notes_df.to_dict('records')
-    all_lab = lab_df.to_dict('records')
-    all_library = library_df.to_dict('records')
+    window = int(window_minutes * 60 * 10**6)
+    windows = list(zip((times - window).tolist(), (times + window).tolist()))
+    profiles = store.profiles()
+    wifi = store.in_windows('wifi', locations, windows)
+    bookings = store.bookings_covering(locations, times)
+    alibi_swipes = store.elsewhere_in_windows('swipes', locations, windows)
+    library = store.elsewhere_in_windows('library', locations, windows)
+    cctv = store.in_windows('cctv', locations, windows)
 
-    
-    # Create a mapping from card_id to the user who owns it
-    card_to_user_map = {user['card_id']: user for user in all_users if pd.notna(user.get('card_id'))}
-    all_user_ids = [user['id'] for user in all_users]
+    entities = profiles['entities']
+    face_users = entities[profiles['face_of_entity'][entities] > 0]
+    detected = np.flatnonzero(cctv['face'] > 0)
+    # Store timestamps are wall-clock microseconds, so every row is "naive".
+    columns = {
+        "anchor_location": locations, "anchor_aware": np.zeros(len(times), dtype=bool), "anchor_time": times,
+        "wifi_user": profiles['entity_of_device'][wifi['device']], "wifi_location": wifi['location'],
+        "wifi_has_time": np.ones(len(wifi['time']), dtype=bool), "wifi_aware": np.zeros(len(wifi['time']), dtype=bool), "wifi_time": wifi['time'],
+        "booking_user": bookings['entity'], "booking_location": bookings['location'],
+        "alibi_user": np.concatenate([profiles['entity_of_card'][alibi_swipes['card']], library['entity']]),
+        "cctv_location": cctv['location'], "cctv_aware": np.zeros(len(cctv['time']), dtype=bool), "cctv_time": cctv['time'],
+        "face_frame": detected, "face_id": cctv['face'][detected],
+        "face_user": face_users, "face_of_user": profiles['face_of_entity'][face_users],
+    }
+    candidates = {
+        "code": entities.tolist(),
+        "id": store.decode(entities),
+        "fullName": store.decode(profiles['name_of_entity'][entities]),
+        "externalId": store.decode(profiles['external_of_entity'][entities]),
+    }
+    return columns, candidates
 
-    features_list = []
-    
-    # Iterate through a sample of swipes to generate training examples
-    for anchor_swipe in all_swipes[:2000]: # Use a subset for faster generation
-        true_owner = card_to_user_map.get(anchor_swipe['card_id'])
+def _training_cache_key(max_swipes):
+    """Content hash of every training CSV plus the feature-code version and sampling settings."""
+    settings = (f"features-v{FEATURE_VERSION}|seed={TRAINING_SEED}|max_swipes={max_swipes}"
+                f"|negatives={NEGATIVE_SAMPLES_PER_SWIPE}|chunk={TRAINING_CHUNK_SIZE}")
+    digest = hashlib.sha256(settings.encode())
+    for key in sorted(TRAINING_CSVS):
+        digest.update(TRAINING_CSVS[key].encode())
+        with open(os.path.join(DATA_DIR, TRAINING_CSVS[key]), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def _load_cached_training_data(cache_key):
+    import pandas as pd
+    if not (os.path.exists(TRAINING_DATA_PATH) and os.path.exists(TRAINING_DATA_META_PATH)):
+        return None
+    with open(TRAINING_DATA_META_PATH) as f:
+        if json.load(f).get('cache_key') != cache_key:
+            return None
+    return pd.read_csv(TRAINING_DATA_PATH)
+
+# Shared, read-only state for training workers; set once per process by _init_training_worker.
+_training_context = {}
+
+def _init_training_worker(context):
+    _training_context.update(context)
+
+def _training_rows_for_chunk(chunk_no, anchor_swipes):
+    """Builds the positive and negative feature rows for one fixed-size chunk of anchor swipes."""
+    ctx = _training_context
+    rng = random.Random(TRAINING_SEED + chunk_no)
+    rows = []
+    for anchor_swipe in anchor_swipes:
+        true_owner = ctx['card_to_user_map'].get(anchor_swipe['card_id'])
         if not true_owner:
             continue
-            
-        # This simulates the "allEvidence" payload sent from the Node.js API
-        # In a real scenario, you'd filter this more intelligently around the event time
-        mock_evidence = {
-            "wifiLogs": all_wifi,
-            "bookings": all_lab,
-            "alibiSwipes": all_library,
-            "cctvFrames": all_cctv,
-            "notes": all_notes,
-            "user_to_face_map": {},
-        }
-        
+
         # --- Positive Sample (the true owner) ---
-        positive_features = create_features_from_raw_data([anchor_swipe], true_owner, mock_evidence)
+        positive_features = create_features_from_raw_data([anchor_swipe], true_owner, ctx['evidence'], ctx['evidence_index'])
         positive_features['is_owner'] = 1
-        features_list.append(positive_features)
+        rows.append(positive_features)
 
         # --- Negative Samples (random other users) ---
-        for _ in range(4): # Generate 4 negative samples for each positive one
-            random_user_id = random.choice(all_user_ids)
+        for _ in range(NEGATIVE_SAMPLES_PER_SWIPE):
+            random_user_id = rng.choice(ctx['all_user_ids'])
             if random_user_id == true_owner['id']:
                 continue
-            
-            random_user = next((user for user in all_users if user['id'] == random_user_id), None)
-            if random_user:
-                negative_features = create_features_from_raw_data([anchor_swipe], random_user, mock_evidence)
-                negative_features['is_owner'] = 0
-                features_list.append(negative_features)
-
-    df = pd.DataFrame(features_list)
+            negative_features = create_features_from_raw_data([anchor_swipe], ctx['users_by_id'][random_user_id], ctx['evidence'], ctx['evidence_index'])
+            negative_features['is_owner'] = 0
+            rows.append(negative_features)
+    return rows
+
+def generate_training_data_from_csvs(workers=None, max_swipes=None):
+    """
+    Reads all raw CSV data and synthesizes a labeled training dataset
+    by calling the SAME feature engineering function used in production.
+    The evidence index is built once and anchor swipes are split across a process pool.
+    Results are cached under a content hash of the CSVs and FEATURE_VERSION.
+    """
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    print("Generating training data from raw CSV files...")
+    try:
+        cache_key = _training_cache_key(max_swipes)
+    except FileNotFoundError as e:
+        print(f"Error: Required CSV not found - {e}. Aborting training.")
+        return None
+
+    cached = _load_cached_training_data(cache_key)
+    if cached is not None:
+        print(f"'{TRAINING_DATA_PATH}' is up to date with the datasets. Loading from file.")
+        return cached
+
+    dataframes = {key: pd.read_csv(os.path.join(DATA_DIR, name)) for key, name in TRAINING_CSVS.items()}
+
+    # Convert dataframes to the list of dictionaries format our API expects
+    all_users = dataframes['users'].rename(columns={'entity_id': 'id', 'full_name': 'fullName', 'student_id': 'externalId'}).to_dict('records')
+    all_swipes = dataframes['swipes'].to_dict('records')
+    if max_swipes is not None:
+        all_swipes = all_swipes[:max_swipes]
+
+    # This simulates the "allEvidence" payload sent from the Node.js API
+    # In a real scenario, you'd filter this more intelligently around the event time
+    evidence = {
+        "wifiLogs": dataframes['wifi'].to_dict('records'),
+        "bookings": dataframes['lab'].to_dict('records'),
+        "alibiSwipes": dataframes['library'].to_dict('records'),
+        "cctvFrames": dataframes['cctv'].to_dict('records'),
+        "user_to_face_map": {},
+    }
+    context = {
+        # Create a mapping from card_id to the user who owns it
+        "card_to_user_map": {user['card_id']: user for user in all_users if pd.notna(user.get('card_id'))},
+        "all_user_ids": [user['id'] for user in all_users],
+        "users_by_id": {user['id']: user for user in all_users},
+        "evidence": evidence,
+        "evidence_index": build_evidence_index(evidence),
+    }
+
+    chunks = [all_swipes[i:i + TRAINING_CHUNK_SIZE] for i in range(0, len(all_swipes), TRAINING_CHUNK_SIZE)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(chunks) <= 1:
+        _init_training_worker(context)
+        chunk_rows = [_training_rows_for_chunk(i, chunk) for i, chunk in enumerate(chunks)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_training_worker, initargs=(context,)) as pool:
+            chunk_rows = list(pool.map(_training_rows_for_chunk, range(len(chunks)), chunks))
+
+    df = pd.DataFrame([row for rows in chunk_rows for row in rows], columns=FEATURE_COLUMNS + ['is_owner'])
     os.makedirs(MODEL_DIR, exist_ok=True)
     df.to_csv(TRAINING_DATA_PATH, index=False)
-    print(f"Training data with {len(df)} samples saved to '{TRAINING_DATA_PATH}'.")
+    with open(TRAINING_DATA_META_PATH, 'w') as f:
+        json.dump({"cache_key": cache_key, "feature_version": FEATURE_VERSION, "anchor_swipes": len(all_swipes), "samples": len(df)}, f, indent=2)
+    print(f"Training data with {len(df)} samples from {len(all_swipes)} anchor swipes saved to '{TRAINING_DATA_PATH}'.")
     return df
 
 # --- Phase 2: Model Training ---
-def train_model():
+def train_model(workers=None, max_swipes=None):
     """
     Loads feature data, trains a model, evaluates it, and saves the artifacts.
     """
+    import joblib
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.metrics import accuracy_score, classification_report
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import StandardScaler
     print("\n--- Starting Model Training ---")
-    features_df = generate_training_data_from_csvs()
+    features_df = generate_training_data_from_csvs(workers=workers, max_swipes=max_swipes)
     if features_df is None: return
 
     X = features_df[FEATURE_COLUMNS]
@@ -193,67 +679,364 @@ def train_model():
     
     joblib.dump(model, MODEL_PATH)
     joblib.dump(scaler, SCALER_PATH)
+    export_serving_artifacts(model, scaler)
     print(f"Model and scaler saved to '{MODEL_DIR}' directory.")
     print("--- Training Complete ---")
 
+def _serving_arrays(model, scaler):
+    return {"scaler_mean": scaler.mean_, "scaler_scale": scaler.scale_, "coef": model.coef_[0], "intercept": model.intercept_}
+
+def export_serving_artifacts(model=None, scaler=None):
+    """Writes the serving bundle and its manifest, from the given model and scaler or the saved pickles."""
+    if model is None or scaler is None:
+        import joblib
+        model, scaler = joblib.load(MODEL_PATH), joblib.load(SCALER_PATH)
+    bundle = write_bundle(SERVING_ARTIFACT_PATH, _serving_arrays(model, scaler))
+    write_manifest(SERVING_MANIFEST_PATH, 'owner', {"model": bundle}, featureColumns=FEATURE_COLUMNS, featureVersion=FEATURE_VERSION)
+
+def load_artifacts():
+    """
+    Loads the scaler and model coefficients from the memory-mapped serving bundle, without
+    importing scikit-learn, or unpickles them if the bundle hasn't been exported yet.
+    Raises ArtifactError if they don't match FEATURE_COLUMNS and FEATURE_VERSION.
+    """
+    manifest = read_manifest(SERVING_MANIFEST_PATH, 'owner', featureColumns=FEATURE_COLUMNS, featureVersion=FEATURE_VERSION)
+    if manifest is not None:
+        arrays = open_bundle(MODEL_DIR, manifest, 'model', required=SERVING_ARRAYS)
+        version = artifact_version([SERVING_MANIFEST_PATH, SERVING_ARTIFACT_PATH])
+    else:
+        import joblib
+        arrays = _serving_arrays(joblib.load(MODEL_PATH), joblib.load(SCALER_PATH))
+        version = artifact_version([MODEL_PATH, SCALER_PATH])
+    n_features = len(FEATURE_COLUMNS)
+    if any(arrays[name].shape != (n_features,) for name in ('scaler_mean', 'scaler_scale', 'coef')) or arrays['intercept'].shape != (1,):
+        raise ArtifactError(f"The owner model in '{MODEL_DIR}' doesn't have {n_features} features like FEATURE_COLUMNS.")
+    return {**arrays, "version": version}
+
 # --- Phase 3: API Deployment ---
 app = Flask(__name__)
-CORS(app)
+CORS(app, resources={r"/predict/*": {}}) # Only the read-only prediction routes are callable from browsers
+
+evidence_store = EvidenceStore.open(EVIDENCE_STORE_DIR)
+
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_SECONDS)
+
+metrics = Metrics('ethos_owner')
+metrics.install(app, endpoints={'predict', 'predict_batch', 'predict_card'})
+metrics.histogram('candidates', "Candidate users scored per request.", COUNT_BUCKETS, label='endpoint')
+metrics.histogram('queries', "Anchor-event sets per batch request.", COUNT_BUCKETS)
 
 try:
-    model = joblib.load(MODEL_PATH)
-    scaler = joblib.load(SCALER_PATH)
+    artifacts = load_artifacts()
+    result_cache.set_version(artifacts['version'])
     print(f"\nModel and scaler loaded successfully from '{MODEL_DIR}'. API is ready.")
 except FileNotFoundError:
-    model, scaler = None, None
+    artifacts = None
+except ArtifactError as e:
+    print(f"\nOwner prediction artifacts can't be used: {e}")
+    artifacts = None
+
+def _score_feature_rows(feature_rows):
+    """
+    Owner probability for each row of a (n, len(FEATURE_COLUMNS)) feature matrix.
+    Equivalent to model.predict_proba(...)[:, 1], but the decision function is summed feature by
+    feature instead of through BLAS, so a row's score doesn't depend on how many rows are scored
+    with it (single vs batch requests, identical candidates ranking as exact ties).
+    """
+    if not len(feature_rows):
+        return np.empty(0)
+    with metrics.span('scaler_transform'):
+        scaled_features = (np.asarray(feature_rows, dtype=float) - artifacts['scaler_mean']) / artifacts['scaler_scale']
+    with metrics.span('predict_proba'):
+        decision = np.full(len(scaled_features), artifacts['intercept'][0])
+        for j, weight in enumerate(artifacts['coef']):
+            decision += scaled_features[:, j] * weight
+        with np.errstate(over='ignore'): # exp overflows to inf for very negative decisions, giving 0.0 as it should
+            return 1.0 / (1.0 + np.exp(-decision))
+
+def _score_pruned(features, defaults):
+    """Scores the hit candidates of every query, and each query's default row only once."""
+    n_queries, n_hits, n_features = features.shape
+    return _score_feature_rows(features.reshape(-1, n_features)).reshape(n_queries, n_hits), _score_feature_rows(defaults)
+
+def _candidate_columns(candidate_users):
+    """The candidate fields the response needs, as {'id', 'fullName', 'externalId'} lists."""
+    fields = ('id', 'fullName', 'externalId')
+    if is_columnar(candidate_users):
+        columns = {field: column(candidate_users.get(field, [])).tolist() for field in fields}
+        check_table('candidateUsers', **columns)
+        return columns
+    if not isinstance(candidate_users, list):
+        raise PayloadError("Invalid request body: 'candidateUsers' must be a list or a column-wise table.")
+    for i, user in enumerate(candidate_users):
+        if not isinstance(user, dict) or any(field not in user for field in fields):
+            raise PayloadError(f"Invalid candidateUsers entry {i}: expected an object with {', '.join(fields)}.")
+    return {field: [user[field] for user in candidate_users] for field in fields}
+
+def _parse_top_k(data):
+    """The optional 'topK' limit on how many ranked predictions to return (default: all)."""
+    top_k = data.get('topK')
+    if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 0):
+        raise PayloadError("Invalid request body: 'topK' must be a non-negative integer.")
+    return top_k
+
+def _explain(features):
+    """The evidence strings shown for one candidate's feature row."""
+    features = dict(zip(FEATURE_COLUMNS, features))
+    evidence = []
+    if features['face_match_in_frame'] == 1: evidence.append(f"User's face was detected by a nearby CCTV camera within {features['time_diff_cctv_face']:.0f} seconds.")
+    if features['has_alibi'] == 1: evidence.append("CONFLICT: User had known activity at a different location.")
+    if features['is_in_booking'] == 1: evidence.append("User had an active booking for this location at the time of the event.")
+    if features['same_location_wifi'] == 1: evidence.append(f"A known device connected to a nearby Wi-Fi AP within {features['time_diff_wifi']:.0f} seconds.")
+    if not evidence: evidence.append("No strong contextual evidence found to link this user.")
+    return evidence
+
+_EVIDENCE_FLAGS = [FEATURE_COLUMNS.index(name) for name in ('face_match_in_frame', 'has_alibi', 'is_in_booking', 'same_location_wifi')]
+
+def _rank_predictions(candidates, hits, features, scores, default_features, default_score, top_k=None):
+    """
+    Builds the explained predictions for one query, best match first (by score, then number
+    of evidence strings, then candidate order). Every candidate is ranked, but response
+    entries and evidence strings are only built for the top_k that are returned.
+    """
+    with metrics.span('ranking'):
+        n_candidates = len(candidates['id'])
+        all_scores = np.full(n_candidates, default_score)
+        all_scores[hits] = scores
+        n_evidence = np.ones(n_candidates, dtype=np.intp) # the "no strong evidence" string
+        n_evidence[hits] = np.maximum((features[:, _EVIDENCE_FLAGS] == 1).sum(axis=1), 1)
+        hit_position = np.full(n_candidates, -1, dtype=np.intp)
+        hit_position[hits] = np.arange(len(hits))
+        ranked = np.lexsort((-n_evidence, -all_scores))[:top_k].tolist()
+
+    with metrics.span('evidence_strings'):
+        response = []
+        for i in ranked:
+            position = hit_position[i]
+            response.append({
+                "user": { "id": candidates['id'][i], "fullName": candidates['fullName'][i], "externalId": candidates['externalId'][i] },
+                "score": all_scores[i],
+                "evidence": _explain(features[position] if position >= 0 else default_features)
+            })
+        return response
+
+def _cached_response(cache_key):
+    """The cached response for cache_key, or None (also for uncacheable requests, whose key is None)."""
+    with metrics.span('cache_lookup'):
+        cached = result_cache.get(cache_key) if cache_key else None
+    return app.response_class(cached, mimetype='application/json') if cached is not None else None
+
+def _cache_response(cache_key, response):
+    if cache_key and response.status_code == 200:
+        result_cache.put(cache_key, response.get_data())
+    return response
+
+@app.errorhandler(PayloadError)
+def payload_error(error):
+    return jsonify({"error": str(error)}), error.status
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Readiness probe: 200 once the model and scaler are loaded, 503 otherwise."""
+    ready = artifacts is not None
+    return jsonify({
+        "status": "ready" if ready else "unavailable", "artifactsLoaded": ready,
+        "evidenceStoreLoaded": evidence_store is not None, "pid": os.getpid(),
+    }), 200 if ready else 503
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters and size of this process's prediction cache."""
+    return jsonify(result_cache.stats())
 
 @app.route('/predict/owner', methods=['POST'])
 def predict():
-    if not model or not scaler:
+    if artifacts is None:
         return jsonify({"error": "Model not trained. Run 'python prediction_service.py train' first."}), 500
 
-    data = request.get_json()
+    with metrics.span('parse'):
+        data = read_request_body(request)
     if 'anchorEvents' not in data or 'candidateUsers' not in data or 'allEvidence' not in data:
         return jsonify({"error": "Invalid request body: Missing required keys."}), 400
 
-    feature_vectors = [create_features_from_raw_data(data['anchorEvents'], user, data['allEvidence']) for user in data['candidateUsers']]
-    features_df = pd.DataFrame(feature_vectors)
-    
-    scaled_features = scaler.transform(features_df)
-    probabilities = model.predict_proba(scaled_features)[:, 1]
-
-    response = []
-    for i, user in enumerate(data['candidateUsers']):
-        features = feature_vectors[i]
-        evidence = []
-        if features['face_match_in_frame'] == 1: evidence.append(f"User's face was detected by a nearby CCTV camera within {features['time_diff_cctv_face']:.0f} seconds.")
-        if features['has_alibi'] == 1: evidence.append("CONFLICT: User had known activity at a different location.")
-        if features['is_in_booking'] == 1: evidence.append("User had an active booking for this location at the time of the event.")
-        if features['same_location_wifi'] == 1: evidence.append(f"A known device connected to a nearby Wi-Fi AP within {features['time_diff_wifi']:.0f} seconds.")
-        if not evidence: evidence.append("No strong contextual evidence found to link this user.")
-        
-        response.append({
-            "user": { "id": user['id'], "fullName": user['fullName'], "externalId": user['externalId'] },
-            "score": probabilities[i],
-            "evidence": evidence
-        })
-
-    sorted_response = sorted(response, key=lambda x: (x['score'], len(x['evidence'])), reverse=True)
-    return jsonify({"predictions": sorted_response})
+    top_k = _parse_top_k(data)
+    with metrics.span('columnize'):
+        candidates = _candidate_columns(data['candidateUsers'])
+        columns = columnize_payload(data['anchorEvents'], data['allEvidence'])
+    with metrics.span('cache_key'):
+        # Keyed on the parsed columns: hashing their buffers is far cheaper than re-serialising the payload.
+        cache_key = array_digest('owner', top_k, result_cache.version, candidates, *(columns[name] for name in sorted(columns)))
+    cached = _cached_response(cache_key)
+    if cached is not None:
+        return cached
+
+    metrics.observe('candidates', len(candidates['id']), 'predict')
+    with metrics.span('features'):
+        hits, features, defaults = build_pruned_features(columns, [columns], candidates['id'])
+    scores, default_scores = _score_pruned(features, defaults)
+
+    predictions = _rank_predictions(candidates, hits, features[0], scores[0], defaults[0], default_scores[0], top_k)
+    with metrics.span('serialize'):
+        return _cache_response(cache_key, jsonify({"predictions": predictions}))
+
+@app.route('/predict/owner/batch', methods=['POST'])
+def predict_batch():
+    """
+    Scores many anchor-event sets (e.g. one per unowned card) against one shared candidate
+    list and evidence section. Evidence is parsed once and every query is featurized and
+    scored in a single vectorized pass; a malformed query gets an 'error' entry instead of
+    failing the batch.
+    """
+    if artifacts is None:
+        return jsonify({"error": "Model not trained. Run 'python prediction_service.py train' first."}), 500
+
+    with metrics.span('parse'):
+        data = read_request_body(request)
+    if not data or 'queries' not in data or 'candidateUsers' not in data or 'allEvidence' not in data:
+        return jsonify({"error": "Invalid request body: Missing required keys."}), 400
+    if not isinstance(data['queries'], list):
+        return jsonify({"error": "Invalid request body: 'queries' must be a list."}), 400
+    top_k = _parse_top_k(data)
+
+    results, anchor_columns, answered = [], [], []
+    for i, query in enumerate(data['queries']):
+        query_id = query.get('id', i) if isinstance(query, dict) else i
+        try:
+            if not isinstance(query, dict) or not isinstance(query.get('anchorEvents'), (list, dict)):
+                raise ValueError("Missing 'anchorEvents' list.")
+            anchor_columns.append(columnize_anchor_events(query['anchorEvents']))
+            answered.append(i)
+            results.append({"id": query_id})
+        except (ValueError, TypeError, AttributeError, PayloadError) as e:
+            results.append({"id": query_id, "error": f"Invalid query: {e}"})
+
+    metrics.observe('queries', len(data['queries']))
+    if answered:
+        with metrics.span('columnize'):
+            candidates = _candidate_columns(data['candidateUsers'])
+            evidence_columns = columnize_evidence(data['allEvidence'])
+        metrics.observe('candidates', len(candidates['id']), 'predict_batch')
+        with metrics.span('features'):
+            hits, features, defaults = build_pruned_features(evidence_columns, anchor_columns, candidates['id'])
+        scores, default_scores = _score_pruned(features, defaults)
+        for k, i in enumerate(answered):
+            results[i]['predictions'] = _rank_predictions(candidates, hits, features[k], scores[k], defaults[k], default_scores[k], top_k)
+
+    with metrics.span('serialize'):
+        return jsonify({"results": results})
+
+@app.route('/predict/owner/card', methods=['POST'])
+def predict_card():
+    """
+    Predicts the owner of a card from the server-side evidence store, so callers only send
+    {'cardId': ..., 'windowMinutes': 3, 'topK': 10} instead of the whole evidence payload.
+    """
+    global evidence_store
+    if artifacts is None:
+        return jsonify({"error": "Model not trained. Run 'python prediction_service.py train' first."}), 500
+    if evidence_store is None: # may have been created since by another worker's ingest
+        evidence_store = EvidenceStore.open(EVIDENCE_STORE_DIR)
+    if evidence_store is None:
+        return jsonify({"error": "Evidence store not built. Run 'python predict_owner.py build-store' first."}), 503
+
+    with metrics.span('parse'):
+        data = read_request_body(request)
+    window_minutes = data.get('windowMinutes', 3)
+    if not isinstance(data.get('cardId'), str) or isinstance(window_minutes, bool) or not isinstance(window_minutes, (int, float)) or window_minutes < 0:
+        return jsonify({"error": "Invalid request body: expected a 'cardId' string and a non-negative 'windowMinutes'."}), 400
+
+    top_k = _parse_top_k(data)
+    # The store's version changes on every ingest, so new evidence never hits a stale entry.
+    cache_key = canonical_digest('owner-card', data['cardId'], window_minutes, top_k, result_cache.version, evidence_store.version())
+    cached = _cached_response(cache_key)
+    if cached is not None:
+        return cached
+
+    with metrics.span('evidence_store'):
+        gathered = columnize_from_store(evidence_store, data['cardId'], window_minutes)
+    if gathered is None:
+        return _cache_response(cache_key, jsonify({"predictions": []}))
+    columns, candidates = gathered
+    metrics.observe('candidates', len(candidates['code']), 'predict_card')
+    with metrics.span('features'):
+        hits, features, defaults = build_pruned_features(columns, [columns], candidates['code'])
+    scores, default_scores = _score_pruned(features, defaults)
+    predictions = _rank_predictions(candidates, hits, features[0], scores[0], defaults[0], default_scores[0], top_k)
+    with metrics.span('serialize'):
+        return _cache_response(cache_key, jsonify({"predictions": predictions}))
+
+@app.route('/evidence/ingest', methods=['POST'])
+def ingest_evidence():
+    """
+    Appends rows to the evidence store: {'table': 'swipes', 'rows': [{...}]} with the
+    datasets/*.csv column names, or {'table': ..., 'columns': {name: [...]}}.
+    Writes feed the security model, so they need the EVIDENCE_INGEST_TOKEN bearer token.
+    """
+    global evidence_store
+    token = os.environ.get(INGEST_TOKEN_ENV)
+    if not token:
+        return jsonify({"error": f"Evidence ingestion is disabled. Set {INGEST_TOKEN_ENV} to enable it."}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()):
+        return jsonify({"error": "Unauthorized."}), 401
+    data = read_request_body(request)
+    table = data.get('table')
+    if isinstance(data.get('rows'), list):
+        names = {name for row in data['rows'] if isinstance(row, dict) for name in row}
+        columns = {name: [row.get(name) if isinstance(row, dict) else None for row in data['rows']] for name in names}
+    elif is_columnar(data.get('columns')):
+        columns = {name: column(values).tolist() for name, values in data['columns'].items()}
+    else:
+        return jsonify({"error": "Invalid request body: expected 'table' and 'rows' or 'columns'."}), 400
+
+    if evidence_store is None:
+        evidence_store = EvidenceStore.create(EVIDENCE_STORE_DIR)
+    try:
+        stored = evidence_store.ingest(table, columns)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"table": table, "ingested": stored})
+
+def build_evidence_store():
+    """Builds the server-side evidence store from the datasets/*.csv files."""
+    print("\n--- Building Evidence Store ---")
+    try:
+        EvidenceStore.build_from_csvs(DATA_DIR, EVIDENCE_STORE_DIR)
+    except FileNotFoundError as e:
+        print(f"Error: Required CSV not found - {e}. Aborting.")
+        return
+    print(f"Evidence store saved to '{EVIDENCE_STORE_DIR}'.")
 
 def run_api():
-    if not model or not scaler:
+    if artifacts is None:
         print("\nCannot start API. Please run 'python prediction_service.py train' first.")
         return
     print(f"\n* Starting Flask server on http://127.0.0.1:{API_PORT}")
     app.run(port=API_PORT, debug=False)
 
+def serve_api(host, port, workers=None):
+    if artifacts is None:
+        print("\nCannot start API. Please run 'python prediction_service.py train' first.")
+        return
+    from serving import serve
+    serve(app, host, port, workers=workers)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Ethos Security: ML Owner Prediction Service")
-    parser.add_argument('mode', choices=['train', 'run'], help="Mode: 'train' to build the model, 'run' to start the API.")
+    parser.add_argument('mode', choices=['train', 'export', 'run', 'serve', 'build-store'], help="Mode: 'train' to build the model, 'export' to write the serving bundle from the saved model, 'run' to start the development API, 'serve' to start the multi-worker API, 'build-store' to load the CSVs into the evidence store.")
+    parser.add_argument('--workers', type=int, default=None, help="Processes used to generate training data, or to serve requests in 'serve' mode (default: all cores).")
+    parser.add_argument('--host', default='127.0.0.1', help="Interface to listen on in 'serve' mode.")
+    parser.add_argument('--port', type=int, default=API_PORT, help=f"Port to listen on in 'serve' mode (default: {API_PORT}).")
+    parser.add_argument('--max-swipes', type=int, default=None, help="Only use the first N swipes as training anchors (default: all).")
     args = parser.parse_args()
 
     if args.mode == 'train':
-        train_model()
+        train_model(workers=args.workers, max_swipes=args.max_swipes)
+    elif args.mode == 'export':
+        export_serving_artifacts()
+        print(f"Serving bundle written to '{SERVING_ARTIFACT_PATH}'.")
     elif args.mode == 'run':
         run_api()
+    elif args.mode == 'serve':
+        serve_api(args.host, args.port, workers=args.workers)
+    elif args.mode == 'build-store':
+        build_evidence_store()
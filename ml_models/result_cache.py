@@ -0,0 +1,138 @@
+"""
+In-process cache of prediction responses, shared by the prediction services.
+
+Operators keep reopening the same unresolved card or timeline gap, and every time the
+whole feature-and-inference pipeline would rerun. Responses are cached as their
+serialised JSON bytes under a digest of everything the prediction depends on, in an
+LRU bounded by total size, with a TTL so answers built on stale evidence age out.
+
+Every key includes the model version, and set_version() drops all entries as soon as
+a different artifact set is loaded. Under 'serve' mode each worker process has its
+own cache.
+"""
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+ENTRY_OVERHEAD_BYTES = 200 # Rough per-entry bookkeeping cost (key, OrderedDict node, tuple).
+
+
+def _json_default(value):
+    """Binary values (MessagePack typed buffers) are hashed instead of serialised."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$bytes": hashlib.blake2b(value, digest_size=16).hexdigest()}
+    raise TypeError(f"Can't hash a {type(value).__name__} value.")
+
+
+def canonical_digest(*parts):
+    """
+    A digest of JSON-like values that doesn't depend on dict key order.
+    Returns None for values that can't be canonicalised (e.g. maps with mixed key types),
+    which callers treat as uncacheable.
+    """
+    try:
+        encoded = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=_json_default)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.blake2b(encoded.encode(), digest_size=16).hexdigest()
+
+
+def array_digest(*parts):
+    """
+    A digest of already-parsed request columns, much cheaper than canonical_digest over the
+    raw payload: numeric arrays are hashed straight from their buffers, object arrays and
+    other values from their pickled contents. Unlike canonical_digest it depends on the
+    order of dict keys, which only costs a cache miss.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        part_digest = hashlib.blake2b(digest_size=16)
+        if isinstance(part, np.ndarray) and not part.dtype.hasobject:
+            part_digest.update(f"{part.dtype.str}{part.shape}".encode())
+            part_digest.update(np.ascontiguousarray(part).data)
+        else:
+            part_digest.update(pickle.dumps(part.tolist() if isinstance(part, np.ndarray) else part, protocol=pickle.HIGHEST_PROTOCOL))
+        digest.update(part_digest.digest())
+    return digest.hexdigest()
+
+
+def artifact_version(paths):
+    """A version token for a set of artifact files that changes whenever any of them is rewritten."""
+    stats = []
+    for path in paths:
+        stat = os.stat(path)
+        stats.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return canonical_digest(stats)
+
+
+class ResultCache:
+    """A thread-safe LRU of bytes values, bounded by total size and entry age."""
+
+    def __init__(self, max_bytes, ttl_seconds, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.version = None
+        self._entries = OrderedDict() # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def set_version(self, version):
+        """Records the loaded model version, dropping every entry if it changed."""
+        with self._lock:
+            if version != self.version:
+                if self._entries:
+                    self._counters['invalidations'] += 1
+                self._entries.clear()
+                self._bytes = 0
+                self.version = version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            value, expires_at, size = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        size = len(key) + len(value) + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            self._entries[key] = (value, self.clock() + self.ttl_seconds, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                **self._counters,
+                "hitRate": self._counters['hits'] / lookups if lookups else 0.0,
+                "entries": len(self._entries), "bytes": self._bytes,
+                "maxBytes": self.max_bytes, "ttlSeconds": self.ttl_seconds,
+                "modelVersion": self.version, "pid": os.getpid(),
+            }
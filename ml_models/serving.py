@@ -0,0 +1,118 @@
+"""
+Pre-fork serving for the prediction services.
+
+'python predict_owner.py run' uses Flask's single-process development server, so
+concurrent dashboard requests queue behind each other. serve() instead binds the
+listening socket once, then forks a pool of worker processes that all accept on it.
+Artifacts are loaded by the parent at import time, before the fork, so the workers
+share them copy-on-write (the evidence store's columns are memory-mapped and shared
+through the page cache anyway) instead of each unpickling its own copy.
+
+SIGTERM or SIGINT shuts the pool down gracefully: every worker finishes the request
+it is handling, stops accepting, and exits. Workers that die unexpectedly are replaced.
+Workers that keep dying right after starting (e.g. on a bad artifact) are replaced with
+growing delays, and after MAX_FAST_FAILURES in a row the pool is shut down and serve()
+exits with status 1 instead of respawning forever.
+"""
+import gc
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from werkzeug.serving import make_server
+
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+FAST_FAILURE_SECONDS = 10 # A worker exiting sooner than this after its start counts as a startup failure
+MAX_FAST_FAILURES = 5 # Consecutive startup failures before the pool gives up
+RESPAWN_BACKOFF_SECONDS = (0.5, 8.0) # First and longest delay before replacing a failed worker
+
+
+def _run_worker(app, host, port, listener):
+    """Worker process: serves requests from the shared socket until asked to stop."""
+    server = make_server(host, port, app, fd=listener.fileno())
+    # The socket is shared, so another worker may win the race for a connection; with a
+    # non-blocking socket the losers' accept() fails and they go back to waiting.
+    server.socket.setblocking(False)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't run on this (the serving) thread.
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def _spawn(app, host, port, listener):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _run_worker(app, host, port, listener)
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        os._exit(code)
+    return pid
+
+
+def serve(app, host, port, workers=None):
+    """Serves a Flask app from a pool of pre-forked worker processes until SIGTERM/SIGINT."""
+    workers = workers or os.cpu_count() or 1
+    listener = socket.create_server((host, port), backlog=128)
+    # Everything allocated so far (the loaded artifacts) is moved out of the garbage
+    # collector's reach, so collections in the workers don't dirty the shared pages.
+    gc.collect()
+    gc.freeze()
+
+    stopping = False
+    started = {} # pid -> monotonic start time
+    fast_failures = 0
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for pid in started:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, stop)
+
+    for _ in range(workers):
+        started[_spawn(app, host, port, listener)] = time.monotonic()
+    print(f"\n* Serving on http://{host}:{port} with {workers} worker processes (parent pid {os.getpid()})")
+
+    while started:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        lifetime = time.monotonic() - started.pop(pid, time.monotonic())
+        if stopping:
+            continue
+        fast_failures = fast_failures + 1 if lifetime < FAST_FAILURE_SECONDS else 0
+        if fast_failures >= MAX_FAST_FAILURES:
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}; {fast_failures} workers in a row "
+                  f"failed within {FAST_FAILURE_SECONDS}s of starting. Shutting down.")
+            stop()
+            continue
+        delay = min(RESPAWN_BACKOFF_SECONDS[0] * 2 ** (fast_failures - 1), RESPAWN_BACKOFF_SECONDS[1]) if fast_failures else 0
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}; starting a replacement"
+              f"{f' in {delay:.1f}s' if delay else ''}.")
+        time.sleep(delay)
+        if not stopping:
+            started[_spawn(app, host, port, listener)] = time.monotonic()
+
+    listener.close()
+    print("All workers stopped.")
+    if fast_failures >= MAX_FAST_FAILURES:
+        sys.exit(1)
@@ -0,0 +1,108 @@
+"""
+Request decoding shared by the prediction services.
+
+Both services accept JSON as before. They also accept MessagePack bodies
+(Content-Type: application/x-msgpack), which are much cheaper to encode and
+decode for the large evidence payloads the owner bridge sends.
+
+In either encoding a table may be sent column-wise ("struct of arrays") instead
+of as a list of row objects, e.g. {"userId": [...], "timestamp": [...]}. A
+column is either a plain array, or, in MessagePack, a typed buffer
+{"dtype": "<i8", "data": <bytes>} that is wrapped with np.frombuffer without
+touching individual values. Timestamps in columnar tables are int64 epoch
+microseconds (UTC), with MISSING_TIMESTAMP marking rows without one.
+"""
+import numpy as np
+
+try:
+    import msgpack
+except ImportError: # Optional: only needed for MessagePack requests
+    msgpack = None
+
+MSGPACK_CONTENT_TYPES = ('application/x-msgpack', 'application/msgpack', 'application/vnd.msgpack')
+MISSING_TIMESTAMP = np.iinfo(np.int64).min
+
+
+class PayloadError(Exception):
+    """A request body that can't be decoded; carries the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def read_request_body(request):
+    """Decodes a Flask request body as MessagePack or JSON depending on its Content-Type."""
+    if request.mimetype in MSGPACK_CONTENT_TYPES:
+        if msgpack is None:
+            raise PayloadError("MessagePack requests need the 'msgpack' package on the server.", status=415)
+        try:
+            return msgpack.unpackb(request.get_data(cache=False), raw=False, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise PayloadError(f"Invalid MessagePack body: {str(e) or type(e).__name__}")
+    data = request.get_json(silent=True)
+    if data is None:
+        raise PayloadError("Invalid request body: expected JSON or MessagePack.")
+    return data
+
+
+def is_columnar(table):
+    """A table is columnar when it arrives as a mapping of column name to column."""
+    return isinstance(table, dict)
+
+
+def column(value, dtype=None):
+    """
+    Turns a wire column into a NumPy array. Typed buffers and homogeneous numeric lists
+    become numeric arrays; anything else (strings, mixed types, nulls) becomes an object array.
+    """
+    if isinstance(value, dict):
+        array = _typed_buffer(value)
+    else:
+        value = value if value is not None else []
+        try:
+            array = np.asarray(value)
+        except ValueError: # ragged nested values
+            array = None
+        if array is not None and array.ndim == 1:
+            if array.dtype.kind not in 'biuf':
+                array = array.astype(object)
+        else:
+            array = np.empty(len(value), dtype=object)
+            for i, item in enumerate(value):
+                array[i] = item
+    return array.astype(dtype, copy=False) if dtype is not None else array
+
+
+def _typed_buffer(value):
+    try:
+        dtype, data = np.dtype(value['dtype']), value['data']
+    except (KeyError, TypeError) as e:
+        raise PayloadError(f"Invalid typed column: expected {{'dtype', 'data'}} ({e}).")
+    if not isinstance(data, (bytes, bytearray)) or dtype.hasobject or dtype.itemsize == 0:
+        raise PayloadError(f"Invalid typed column: dtype '{dtype.str}' with {type(data).__name__} data can't be wrapped as a buffer.")
+    if len(data) % dtype.itemsize:
+        raise PayloadError(f"Invalid typed column: {len(data)} bytes isn't a whole number of '{dtype.str}' values.")
+    return np.frombuffer(data, dtype=dtype)
+
+
+def check_table(name, **columns):
+    """Raises PayloadError unless every column of a column-wise table has the same length."""
+    lengths = {key: len(values) for key, values in columns.items()}
+    if len(set(lengths.values())) > 1:
+        raise PayloadError(f"Invalid request body: the columns of '{name}' have different lengths {lengths}.")
+
+
+def encode_column(array):
+    """Client-side helper: a NumPy array as a typed-buffer column (object arrays stay plain lists)."""
+    array = np.asarray(array)
+    if array.dtype.kind in 'biuf':
+        return {"dtype": array.dtype.str, "data": np.ascontiguousarray(array).tobytes()}
+    return array.tolist()
+
+
+def packb(payload):
+    """Client-side helper: serialises a payload (typically with encode_column columns) as MessagePack."""
+    if msgpack is None:
+        raise RuntimeError("The 'msgpack' package is required to encode MessagePack payloads.")
+    return msgpack.packb(payload, use_bin_type=True)
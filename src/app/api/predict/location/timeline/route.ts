@@ -0,0 +1,76 @@
+import { db } from "@/database";
+import { users } from "@/database/schema";
+import { eq } from "drizzle-orm";
+import { NextRequest, NextResponse } from "next/server";
+
+export const dynamic = 'force-dynamic';
+const PYTHON_API_URL = process.env.PYTHON_LOCATION_API_URL || "http://127.0.0.1:5002";
+
+type Gap = { id?: string | number, start: string, end: string, locationBefore?: { name: string } | null, locationAfter?: { name: string } | null };
+
+export async function POST(req: NextRequest) {
+    const { userId, gaps } = await req.json() as { userId: number, gaps: Gap[] };
+
+    if (!userId || !Array.isArray(gaps) || gaps.length === 0) {
+        return NextResponse.json({ error: "Missing required parameters: userId and a non-empty gaps list are required." }, { status: 400 });
+    }
+
+    try {
+        // --- 1. GATHER THE USER'S HISTORY ONCE FOR ALL GAPS ---
+
+        const allLocations = await db.query.locations.findMany();
+        const userActivity = await db.query.users.findFirst({
+            where: eq(users.id, userId),
+            with: {
+                campusCards: { with: { swipeLogs: true } },
+                devices: { with: { wifiLogs: true } },
+                roomBookings: true,
+            }
+        });
+
+        if (!userActivity) {
+            throw new Error("User not found");
+        }
+
+        const historicalActivity: { locationId: number | null, timestamp: Date }[] = [];
+        userActivity.campusCards.forEach(c => c.swipeLogs.forEach(l => { if (l.locationId && l.timestamp) historicalActivity.push({ locationId: l.locationId, timestamp: l.timestamp }) }));
+        userActivity.devices.forEach(d => d.wifiLogs.forEach(l => { if (l.accessPointId && l.timestamp) historicalActivity.push({ locationId: l.accessPointId, timestamp: l.timestamp }) }));
+        userActivity.roomBookings.forEach(b => { if (b.locationId && b.startTime) historicalActivity.push({ locationId: b.locationId, timestamp: b.startTime }) });
+
+        // --- 2. TURN THE GAPS INTO ONE ORDERED TIMELINE ---
+        // Each gap becomes its known neighbours plus one unknown step; the same location at the
+        // same time shared by two consecutive gaps appears once, so the decode links them.
+        const timeline: { id?: string | number, startTime: string, location?: { name: string } }[] = [];
+        // Gaps without an id are answered under their index in the caller's array, not the sorted one.
+        const sortedGaps = gaps.map((gap, index) => ({ gap, index }))
+            .sort((a, b) => new Date(a.gap.start).getTime() - new Date(b.gap.start).getTime());
+        sortedGaps.forEach(({ gap, index }) => {
+            const previous = timeline[timeline.length - 1];
+            const alreadyAdded = previous?.location && previous.startTime === gap.start && previous.location.name === gap.locationBefore?.name;
+            if (gap.locationBefore && !alreadyAdded) {
+                timeline.push({ startTime: gap.start, location: gap.locationBefore });
+            }
+            timeline.push({ id: gap.id ?? index, startTime: gap.start });
+            if (gap.locationAfter) {
+                timeline.push({ startTime: gap.end, location: gap.locationAfter });
+            }
+        });
+
+        // --- 3. CALL THE PYTHON API ONCE FOR EVERY GAP ---
+        const pythonResponse = await fetch(`${PYTHON_API_URL}/predict/location/timeline`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ allLocations, historicalActivity, timeline }),
+        });
+
+        if (!pythonResponse.ok) {
+            throw new Error(`Python Location API Error: ${await pythonResponse.text()}`);
+        }
+
+        return NextResponse.json(await pythonResponse.json());
+
+    } catch (error) {
+        console.error("Location timeline bridge API error:", error);
+        return NextResponse.json({ error: "Internal server error" }, { status: 500 });
+    }
+}